@@ -15,7 +15,9 @@ requirements = ['Click>=6.0', 'pyyaml', 'boto3', 'everett[ini]', 'botocore', 'Ji
 
 setup_requirements = ['pytest-runner']
 
-test_requirements = ['pytest', 'pytest-watch', 'pytest-cov', 'moto']
+test_requirements = ['pytest', 'pytest-watch', 'pytest-cov', 'moto>=5']
+
+extras_requirements = {'native': ['yara-python>=4.3']}
 
 setup(
     author="Andrew J Krug",
@@ -29,6 +31,7 @@ setup(
         'Programming Language :: Python :: 3.7',
     ],
     description="A python module for orchestrating content acquisitions and light analysis via amazon ssm.",
+    extras_require=extras_requirements,
     entry_points={
         'console_scripts': [
             'ssm_acquire=ssm_acquire.cli:main',
@@ -7,8 +7,12 @@ __email__ = 'andrewkrug@gmail.com'
 __version__ = '0.1.0.5'
 
 from ssm_acquire import analyze
+from ssm_acquire import baseline
 from ssm_acquire import cli
 from ssm_acquire import common
 from ssm_acquire import credential
+from ssm_acquire import metrics
+from ssm_acquire import remote
+from ssm_acquire import store
 
-__all__ = [analyze, cli, common, credential]
+__all__ = [analyze, baseline, cli, common, credential, metrics, remote, store]
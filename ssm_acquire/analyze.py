@@ -1,16 +1,36 @@
 """Runs a docker container and more to perform automated analysis of memory dumps."""
+import binascii
 import boto3
+import datetime
 import docker
+import json
 import os
 
+from botocore.exceptions import ClientError
 from builtins import FileExistsError
+from builtins import FileNotFoundError
 from logging import getLogger
+from ssm_acquire import cache
 from ssm_acquire import common
+from ssm_acquire import metrics
+from ssm_acquire import remote
+from ssm_acquire import sparse
 
 
 config = common.get_config()
 logger = getLogger(__name__)
 
+DOWNLOAD_CHUNK_SIZE = 8 * remote.MIB
+FLAT_CAPTURE = 'capture.aff4'
+SPARSE_CAPTURE = 'capture.sparse'
+
+
+def _parse_docker_time(value):
+    # Docker reports nanosecond precision, e.g. 2018-11-25T20:03:01.123456789Z
+    stamp, _, fraction = value.rstrip('Z').partition('.')
+    parsed = datetime.datetime.strptime(stamp, '%Y-%m-%dT%H:%M:%S')
+    return parsed + datetime.timedelta(microseconds=int((fraction + '000000')[:6]))
+
 
 class S3Manager(object):
     def __init__(self, credentials, bucket_name):
@@ -21,11 +41,13 @@ class S3Manager(object):
     def _connect(self):
         if self.s3_client is None:
             logger.info('Intializing an S3 Client.')
-            self.s3_client = boto3.client(
-                's3',
-                aws_access_key_id=self.credentials['Credentials']['AccessKeyId'],
-                aws_secret_access_key=self.credentials['Credentials']['SecretAccessKey'],
-                aws_session_token=self.credentials['Credentials']['SessionToken']
+            self.s3_client = metrics.instrument_client(
+                boto3.client(
+                    's3',
+                    aws_access_key_id=self.credentials['Credentials']['AccessKeyId'],
+                    aws_secret_access_key=self.credentials['Credentials']['SecretAccessKey'],
+                    aws_session_token=self.credentials['Credentials']['SessionToken']
+                )
             )
 
     def list_objects_for_key(self, object_key):
@@ -46,21 +68,52 @@ class S3Manager(object):
         self._connect()
         for object_key in object_keys:
             logger.info('Attempting download of: {}'.format(object_key))
-            response = self.s3_client.get_object(
+            with metrics.span('s3_download', key=object_key.get('Key')) as span:
+                response = self.s3_client.get_object(
+                    Bucket=self.bucket_name,
+                    Key=object_key.get('Key')
+                )
+                size = 0
+                with open('/tmp/{}'.format(object_key.get('Key')), 'wb') as fh:
+                    # Stream to disk so captures larger than RAM can be downloaded.
+                    for chunk in response['Body'].iter_chunks(DOWNLOAD_CHUNK_SIZE):
+                        size += fh.write(chunk)
+                span['attributes']['bytes'] = size
+            metrics.increment('s3_bytes_downloaded_total', size)
+            logger.info('File retrieval complete for: {}'.format(object_key))
+
+    def open_object(self, object_key):
+        """Return a lazily fetched, seekable file-like object for object_key."""
+        self._connect()
+        logger.info('Opening s3://{}/{} for ranged reads.'.format(self.bucket_name, object_key))
+        return remote.S3RangeReader(self.s3_client, self.bucket_name, object_key)
+
+    def get_metadata(self, object_key):
+        """Return the user metadata of an object or None if it does not exist."""
+        self._connect()
+        try:
+            response = self.s3_client.head_object(
                 Bucket=self.bucket_name,
-                Key=object_key.get('Key')
+                Key=object_key
             )
-            fh = open('/tmp/{}'.format(object_key.get('Key')), 'wb')
-            fh.write(response['Body'].read())
-            fh.close()
-            logger.info('File retrieval complete for: {}'.format(object_key))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return response.get('Metadata', {})
 
-    def put_file(self, file_path, instance_id):
+    def put_file(self, file_path, instance_id, cache_key=None):
         self._connect()
         logger.info('Uploading result: {} from file_path: {}'.format(file_path.split('/')[3], file_path))
         object_key = '{}/{}'.format(instance_id, file_path.split('/')[3])
-        with open(file_path, 'rb') as data:
-            self.s3_client.upload_fileobj(data, self.bucket_name, object_key)
+        extra_args = None
+        if cache_key is not None:
+            extra_args = {'Metadata': {cache.CACHE_KEY_METADATA: cache_key}}
+        size = os.path.getsize(file_path)
+        with metrics.span('s3_upload', key=object_key, bytes=size):
+            with open(file_path, 'rb') as data:
+                self.s3_client.upload_fileobj(data, self.bucket_name, object_key, ExtraArgs=extra_args)
+        metrics.increment('s3_bytes_uploaded_total', size)
 
 
 class RekallManager(object):
@@ -80,23 +133,98 @@ class RekallManager(object):
         ]
 
     def download_incident_data(self):
+        """Download the objects of the instance that are not already in /tmp/<instance_id>.
+
+        Sparse captures are only read in place by run_native_yara_scan, so they are not downloaded.  Nor
+        is the command output ssm keeps under <instance_id>/ssm-output/.
+        """
         temp_dir = '/tmp/{}'.format(self.instance_id)
-        if os.path.isdir(temp_dir) and len(os.listdir(temp_dir)) != 0:
-            logger.info('Temp directory already exists.  Skipping re: fetch.')
-            result = os.listdir(temp_dir)
-        else:
+        s3_manager = S3Manager(self.credentials, self.bucket_name)
+        s3_manager.create_instance_directory(self.instance_id)
+        missing = []
+        for key in s3_manager.list_objects_for_key(self.instance_id) or []:
+            if key['Key'] == self._capture_key(SPARSE_CAPTURE):
+                continue
+            if os.path.dirname(key['Key']) != self.instance_id:
+                logger.debug('Not downloading: {}'.format(key['Key']))
+                continue
+            local_path = '/tmp/{}'.format(key['Key'])
+            # A new capture of the same instance has the same size, so compare the upload time too.
+            if os.path.isfile(local_path) and os.path.getsize(local_path) == key['Size'] and \
+                    os.path.getmtime(local_path) >= key['LastModified'].timestamp():
+                continue
+            missing.append(key)
+        if missing:
             logger.info('Attempting to download incident data.')
-            s3_manager = S3Manager(self.credentials, self.bucket_name)
-            s3_manager.create_instance_directory(self.instance_id)
-            keys = s3_manager.list_objects_for_key(self.instance_id)
-            result = s3_manager.get_files(keys)
-        return result
+            s3_manager.get_files(missing)
+        else:
+            logger.info('All incident data is already in: {}.  Skipping re: fetch.'.format(temp_dir))
+        return os.listdir(temp_dir)
 
     def _get_rekall_profile_name(self):
         for file_name in os.listdir('/tmp/{}'.format(self.instance_id)):
             if file_name.endswith('.zip'):
                 return file_name
 
+    def _get_image_digest(self):
+        try:
+            image = self.client.images.get(self.docker_image)
+        except docker.errors.ImageNotFound:
+            image = self.pull_rekall_image()
+        return image.id
+
+    def _capture_key(self, capture_name):
+        return '{}/{}'.format(self.instance_id, capture_name)
+
+    def _has_capture(self):
+        """True when the flat capture rekall needs is on disk, logging why analysis cannot run if not."""
+        temp_dir = '/tmp/{}'.format(self.instance_id)
+        if os.path.isfile(os.path.join(temp_dir, FLAT_CAPTURE)):
+            return True
+        s3_manager = S3Manager(self.credentials, self.bucket_name)
+        if s3_manager.get_metadata(self._capture_key(SPARSE_CAPTURE)) is not None:
+            logger.error(
+                'Only a sparse capture exists for instance: {}.  The rekall plugins need {}, '
+                'only yara triage runs against {}.'.format(self.instance_id, FLAT_CAPTURE, SPARSE_CAPTURE)
+            )
+        else:
+            logger.error('No capture.aff4 found in: {}.  Skipping analysis.'.format(temp_dir))
+        return False
+
+    def _analysis_inputs(self, result_cache):
+        """The parts of a result cache key shared by every plugin run against this capture."""
+        temp_dir = '/tmp/{}'.format(self.instance_id)
+        return {
+            'capture': result_cache.file_digest(os.path.join(temp_dir, FLAT_CAPTURE)),
+            'profile': result_cache.file_digest(os.path.join(temp_dir, self._get_rekall_profile_name())),
+            'image': self._get_image_digest()
+        }
+
+    def _wait_for_container(self, container, plugin, timeout=600):
+        """Wait on a container, record the runtime docker reports for it and return its exit status."""
+        status_code = container.wait(timeout=timeout).get('StatusCode')
+        metrics.increment('containers_run_total', plugin=plugin, status=status_code)
+        if status_code != 0:
+            logger.error(
+                'The {} container exited with status: {}. Logs: {}'.format(plugin, status_code, container.logs())
+            )
+        container.reload()
+        state = container.attrs.get('State', {})
+        try:
+            runtime = _parse_docker_time(state['FinishedAt']) - _parse_docker_time(state['StartedAt'])
+        except (KeyError, ValueError):
+            logger.debug('No runtime reported for the {} container.'.format(plugin))
+        else:
+            metrics.observe('container_seconds', runtime.total_seconds(), plugin=plugin)
+        return status_code
+
+    def _discard_output(self, output_name):
+        """Remove any partial output of a failed container so it is not mistaken for a result."""
+        try:
+            os.remove('/tmp/{}/{}'.format(self.instance_id, output_name))
+        except FileNotFoundError:
+            pass
+
     def _run_a_container(
         self,
         command,
@@ -112,21 +240,105 @@ class RekallManager(object):
     def pull_rekall_image(self):
         return self.client.images.pull(self.docker_image)
 
-    def run_yara_scan(self):
-        yara_file_dir = config('yara_file_dir', namespace='ssm_acquire', default='~/.yarafiles')
-        rekall_profile_name = self._get_rekall_profile_name()
-        if os.path.isdir(yara_file_dir) and len(os.listdir(yara_file_dir)) != 0:
-            for yara_file in os.listdir(yara_file_dir):
-                plugin = 'yarascan'
-                additional_arg = '--yara_file /opt/yarascan/{}'.format(yara_file)
-                command = 'rekall -f /files/capture.aff4 --profile /files/{}json {} {} \
-                        --format=json --output=/files/{}-{}-output.json'.format(
-                    rekall_profile_name.split('zip')[0],
-                    plugin,
-                    additional_arg,
-                    'yara-scan-{}'.format(yara_file),
-                    self.instance_id
+    def _yara_file_dir(self):
+        return os.path.expanduser(
+            config('yara_file_dir', namespace='ssm_acquire', default='~/.yarafiles')
+        )
+
+    def _yara_files(self):
+        yara_file_dir = self._yara_file_dir()
+        if not os.path.isdir(yara_file_dir):
+            return []
+        return sorted(os.listdir(yara_file_dir))
+
+    def run_native_yara_scan(self):
+        """Scan the capture in the asset store with every yara rule file without downloading it.
+
+        Returns False when the scan could not run, in which case run_yara_scan scans with docker instead.
+        """
+        yara_files = self._yara_files()
+        if not yara_files:
+            return False
+
+        s3_manager = S3Manager(self.credentials, self.bucket_name)
+        for capture_name in (FLAT_CAPTURE, SPARSE_CAPTURE):
+            capture_key = self._capture_key(capture_name)
+            if s3_manager.get_metadata(capture_key) is not None:
+                break
+        else:
+            logger.error('No capture found in the asset store for instance: {}'.format(self.instance_id))
+            return False
+
+        if not NativeRekall.available():
+            if capture_name == SPARSE_CAPTURE:
+                logger.error(
+                    'yara-python is not installed, install ssm_acquire[native] to scan the sparse capture of '
+                    'instance: {}.'.format(self.instance_id)
                 )
+            else:
+                logger.info('yara-python is not installed, install ssm_acquire[native] to scan without downloading.')
+            return False
+        s3_manager.create_instance_directory(self.instance_id)
+        result_cache = cache.ResultCache(self.instance_id, s3_manager)
+        native = NativeRekall(capture_key, self.credentials)
+
+        for yara_file in yara_files:
+            output_name = '{}-{}-output.json'.format('yara-scan-{}'.format(yara_file), self.instance_id)
+            yara_path = os.path.join(self._yara_file_dir(), yara_file)
+            key = cache.cache_key(
+                plugin='native_yarascan',
+                rules=result_cache.file_digest(yara_path),
+                capture=native.capture_digest()
+            )
+            if result_cache.is_current(output_name, key):
+                continue
+
+            logger.info('Scanning {} with rule file: {}.'.format(capture_key, yara_file))
+            with metrics.span('native_yarascan', rules=yara_file):
+                matches = native.yara_scan(yara_path)
+            output_path = '/tmp/{}/{}'.format(self.instance_id, output_name)
+            with open(output_path, 'w') as fh:
+                json.dump([['m', {'plugin_name': 'yarascan'}]] + [['r', match] for match in matches], fh)
+            s3_manager.put_file(output_path, self.instance_id, cache_key=key)
+            result_cache.record(output_name, key)
+        return True
+
+    def run_yara_scan(self, result_cache=None, inputs=None):
+        yara_file_dir = self._yara_file_dir()
+        rekall_profile_name = self._get_rekall_profile_name()
+        if not self._yara_files():
+            logger.info('No yara files found.  Skipping yarascan.')
+            return []
+        if not self._has_capture():
+            return []
+
+        if result_cache is None:
+            result_cache = cache.ResultCache(self.instance_id, S3Manager(self.credentials, self.bucket_name))
+        if inputs is None:
+            inputs = self._analysis_inputs(result_cache)
+        s3_manager = S3Manager(self.credentials, self.bucket_name)
+
+        logs = []
+        for yara_file in self._yara_files():
+            plugin = 'yarascan'
+            additional_arg = '--yara_file /opt/yarascan/{}'.format(yara_file)
+            output_name = '{}-{}-output.json'.format('yara-scan-{}'.format(yara_file), self.instance_id)
+            key = cache.cache_key(
+                plugin=plugin,
+                args=additional_arg,
+                rules=result_cache.file_digest(os.path.join(yara_file_dir, yara_file)),
+                **inputs
+            )
+            if result_cache.is_current(output_name, key):
+                continue
+
+            command = 'rekall -f /files/capture.aff4 --profile /files/{}json {} {} \
+                    --format=json --output=/files/{}'.format(
+                rekall_profile_name.split('zip')[0],
+                plugin,
+                additional_arg,
+                output_name
+            )
             container = self._run_a_container(
                 command,
                 {
@@ -135,75 +347,179 @@ class RekallManager(object):
                 }
             )
 
-            logger.info('Waiting for yarascan to exit.')
-            container.wait(timeout=600)
-            print(container.logs())
+            logger.info('Waiting for yarascan to exit for rule file: {}.'.format(yara_file))
+            status_code = self._wait_for_container(container, plugin)
+            logs.append(container.logs())
             container.remove()
-        else:
-            logger.info('No yara files found.  Skipping yarascan.')
+            if status_code != 0:
+                logger.error('Not storing the yarascan result for rule file: {}.'.format(yara_file))
+                self._discard_output(output_name)
+                continue
+
+            s3_manager.put_file('/tmp/{}/{}'.format(self.instance_id, output_name), self.instance_id, cache_key=key)
+            result_cache.record(output_name, key)
+        return logs
+
+    def run_rekall_plugins(self, yara=True):
+        """Run the rekall plugins and, unless yara is False, a yarascan per rule file in docker."""
+        if not self._has_capture():
+            return []
+        s3_manager = S3Manager(self.credentials, self.bucket_name)
+        result_cache = cache.ResultCache(self.instance_id, s3_manager)
+        inputs = self._analysis_inputs(result_cache)
 
-    def run_rekall_plugins(self):
         # Build the json version of the rekall profile first
         rekall_profile_name = self._get_rekall_profile_name()
-
-        logger.info('Attempting to convert the zip of the rekall profile to json'.format(rekall_profile_name))
-        command = 'rekall convert_profile {} {}json'.format(
-            rekall_profile_name,
-            rekall_profile_name.split('zip')[0]
-        )
+        profile_json_name = '{}json'.format(rekall_profile_name.split('zip')[0])
+        profile_key = cache.cache_key(plugin='convert_profile', profile=inputs['profile'], image=inputs['image'])
         volumes = {
             '/tmp/{}'.format(self.instance_id):
                 {'bind': '/files', 'mode': 'rw'}
         }
-        container = self._run_a_container(command, volumes)
-        container.stop()
-        container.remove()
-        logger.info('The rekall profile was converted from a zip file to a json file.')
+
+        if result_cache.manifest['results'].get(profile_json_name) == profile_key and \
+                os.path.isfile('/tmp/{}/{}'.format(self.instance_id, profile_json_name)):
+            logger.info('The json rekall profile is current.  Skipping conversion.')
+        else:
+            logger.info('Attempting to convert the zip of the rekall profile to json'.format(rekall_profile_name))
+            command = 'rekall convert_profile {} {}'.format(
+                rekall_profile_name,
+                profile_json_name
+            )
+            container = self._run_a_container(command, volumes)
+            status_code = self._wait_for_container(container, 'convert_profile')
+            container.remove()
+            if status_code != 0:
+                logger.error('Conversion of the rekall profile: {} failed.  Skipping analysis.'.format(rekall_profile_name))
+                return []
+            result_cache.record(profile_json_name, profile_key)
+            logger.info('The rekall profile was converted from a zip file to a json file.')
         logger.info('Begin analysis of the memory sample for the following plugins: {}'.format(self.rekall_plugins))
 
         plugin_containers = []
         for plugin in self.rekall_plugins:
+            output_name = '{}-{}-output.json'.format(plugin, self.instance_id)
+            key = cache.cache_key(plugin=plugin, args='', **inputs)
+            if result_cache.is_current(output_name, key):
+                continue
+
             logger.info('Running the following plugin: {} on capture.aff4.'.format(plugin))
-            command = 'rekall -f /files/capture.aff4 --profile /files/{}json {} \
-                    --format=json --output=/files/{}-{}-output.json'.format(
-                rekall_profile_name.split('zip')[0],
-                plugin,
+            command = 'rekall -f /files/capture.aff4 --profile /files/{} {} \
+                    --format=json --output=/files/{}'.format(
+                profile_json_name,
                 plugin,
-                self.instance_id
+                output_name
             )
-            volumes = {
-                '/tmp/{}'.format(self.instance_id): {'bind': '/files', 'mode': 'rw'}
-            }
             container = self._run_a_container(command, volumes)
             plugin_containers.append(
                 {
                     'plugin': plugin,
-                    'container': container
+                    'container': container,
+                    'output_name': output_name,
+                    'key': key
                 }
             )
 
         logs = []
-        s3_manager = S3Manager(self.credentials, self.bucket_name)
 
         for container in plugin_containers:
             # For some reason .status is an object property
             logger.info('Waiting for analysis to complete on: {}'.format(container['plugin']))
-            container['container'].wait(timeout=600)
+            container['status_code'] = self._wait_for_container(container['container'], container['plugin'])
             logs.append(container['container'].logs())
             container['container'].remove()
 
-        for plugin in self.rekall_plugins:
-            logger.info('Uploading results for plugin: {}'.format(plugin))
+        for container in plugin_containers:
+            if container['status_code'] != 0:
+                logger.error('Not storing the result of the failed plugin: {}'.format(container['plugin']))
+                self._discard_output(container['output_name'])
+                continue
+            logger.info('Uploading results for plugin: {}'.format(container['plugin']))
             s3_manager.put_file(
-                '/tmp/{}/{}-{}-output.json'.format(self.instance_id, plugin, self.instance_id), self.instance_id
+                '/tmp/{}/{}'.format(self.instance_id, container['output_name']),
+                self.instance_id,
+                cache_key=container['key']
             )
+            result_cache.record(container['output_name'], container['key'])
 
-        self.run_yara_scan()
+        if yara:
+            logs.extend(self.run_yara_scan(result_cache, inputs))
 
         logger.info('Rekall plugin run complete.')
         return logs
 
 
 class NativeRekall(object):
-    def __init__(self, object_key):
+    def __init__(self, object_key, credentials):
         self.object_key = object_key
+        self.credentials = credentials
+        self.bucket_name = config('asset_bucket', namespace='ssm_acquire')
+        self.capture = None
+
+    @staticmethod
+    def available():
+        """True when the optional yara-python dependency is installed."""
+        try:
+            import yara  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def open_capture(self):
+        """Open the capture in the asset store without downloading it.
+
+        Sparse captures are presented as the original flat image.
+        """
+        if self.capture is None:
+            s3_manager = S3Manager(self.credentials, self.bucket_name)
+            capture = s3_manager.open_object(self.object_key)
+            if self.object_key.endswith('.sparse'):
+                capture = sparse.SparseImageReader(capture)
+            self.capture = capture
+        return self.capture
+
+    def capture_digest(self):
+        """Identify the capture for the result cache without reading all of it.
+
+        Sparse images carry the sha256 of the original image; flat captures use the S3 ETag.
+        """
+        capture = self.open_capture()
+        if isinstance(capture, sparse.SparseImageReader):
+            return binascii.hexlify(capture.sha256).decode('ascii')
+        return 'etag:{}'.format(capture.etag)
+
+    def yara_scan(self, yara_file, window_size=16 * remote.MIB, overlap=4096):
+        """Match a yara rule file against the remote capture in overlapping windows.
+
+        Returns one dict per matched string instance located by its offset in the whole image.
+        Instances starting in the overlap are left to the following window so none are reported twice.
+        """
+        import yara  # Optional dependency, only needed for native triage.
+
+        rules = yara.compile(filepath=yara_file)
+        capture = self.open_capture()
+        matches = []
+        offset = 0
+        while offset < capture.size:
+            data = capture.read_at(offset, window_size + overlap)
+            for match in rules.match(data=data):
+                for string_match in match.strings:
+                    for instance in string_match.instances:
+                        if instance.offset >= window_size:
+                            continue
+                        matches.append(
+                            {
+                                'offset': offset + instance.offset,
+                                'rule': match.rule,
+                                'identifier': string_match.identifier,
+                                'length': instance.matched_length
+                            }
+                        )
+            offset += window_size
+        remote_capture = getattr(capture, 'source', capture)
+        logger.info(
+            'Yara scan of {} fetched {} bytes in {} requests.'.format(
+                self.object_key, remote_capture.bytes_fetched, remote_capture.requests
+            )
+        )
+        return matches
@@ -0,0 +1,260 @@
+"""Fleet baselines of process, network and module state built from the results store."""
+import hashlib
+import ipaddress
+import json
+import re
+
+from logging import getLogger
+from ssm_acquire import common
+from ssm_acquire import store
+
+
+config = common.get_config()
+logger = getLogger(__name__)
+
+BASELINE_PLUGINS = ['psaux', 'netstat', 'pidhashtable', 'osquery:']
+
+# Columns that differ between otherwise identical instances and would make every row unique.
+VOLATILE_KEY = re.compile(r'(^|[._])(pid|ppid|tid|offset|inode|socket|fd|time|uptime|vm|dtb)$')
+VOLATILE_VALUE = re.compile(r'^0x[0-9a-fA-F]{8,}$')
+
+# Socket ports.  A bare port column, as in osquery's listening_ports, is always a listening port.
+LOCAL_PORT_KEY = re.compile(r'(^|[._])(local_port|src_port|sport|lport)$')
+REMOTE_PORT_KEY = re.compile(r'(^|[._])(remote_port|dst_port|dport|rport)$')
+STATE_KEY = re.compile(r'(^|[._])state$')
+WELL_KNOWN_PORTS = 1024
+EPHEMERAL_PORT = 'ephemeral'
+
+# Bump when stable_fields changes so stored fingerprints are recomputed.
+FINGERPRINT_VERSION = 2
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS fingerprints (
+        row_id INTEGER PRIMARY KEY,
+        instance_id TEXT NOT NULL,
+        plugin TEXT NOT NULL,
+        fingerprint INTEGER NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS fingerprint_labels (
+        plugin TEXT NOT NULL,
+        fingerprint INTEGER NOT NULL,
+        label TEXT NOT NULL,
+        PRIMARY KEY (plugin, fingerprint)
+    )""",
+    'CREATE INDEX IF NOT EXISTS fingerprints_plugin ON fingerprints (plugin, fingerprint, instance_id)',
+    'CREATE INDEX IF NOT EXISTS fingerprints_instance ON fingerprints (instance_id, plugin)',
+    'CREATE TABLE IF NOT EXISTS fingerprint_version (version INTEGER NOT NULL)',
+]
+
+
+def address_class(value):
+    """Reduce an ip address to the kind of address it is, or return None for other values."""
+    if '.' not in value and ':' not in value:
+        return None
+    try:
+        address = ipaddress.ip_address(value)
+    except ValueError:
+        return None
+    for name in ('unspecified', 'loopback', 'link_local', 'private', 'multicast'):
+        if getattr(address, 'is_{}'.format(name)):
+            return '{}-{}'.format(name.replace('_', '-'), 'ipv{}'.format(address.version))
+    return 'public-ipv{}'.format(address.version)
+
+
+def _stable_port(value, keep):
+    try:
+        port = int(value)
+    except (TypeError, ValueError):
+        return value
+    if keep or port < WELL_KNOWN_PORTS:
+        return value
+    return EPHEMERAL_PORT
+
+
+def stable_fields(row):
+    """Return the sorted (key, value) pairs of a row that are expected to match across a fleet.
+
+    Addresses are reduced to their class, e.g. private-ipv4, and ports other than listening and
+    well known ones become 'ephemeral', so the same socket on two instances has the same fields.
+    """
+    pairs = list(store.flatten(row))
+    listening = any(
+        value is not None and value.upper() in ('LISTEN', 'LISTENING') for key, value in pairs if STATE_KEY.search(key.lower())
+    ) or any(value in ('0', '*') for key, value in pairs if REMOTE_PORT_KEY.search(key.lower()))
+
+    fields = []
+    for key, value in pairs:
+        lowered = key.lower()
+        if VOLATILE_KEY.search(lowered):
+            continue
+        if value is not None and VOLATILE_VALUE.match(value):
+            continue
+        if LOCAL_PORT_KEY.search(lowered):
+            value = _stable_port(value, listening)
+        elif REMOTE_PORT_KEY.search(lowered):
+            value = _stable_port(value, False)
+        elif value is not None:
+            value = address_class(value) or value
+        fields.append((key, value))
+    return sorted(fields)
+
+
+def fingerprint(fields):
+    """Hash stable fields into a signed 64 bit integer suitable for an sqlite index."""
+    digest = hashlib.blake2b(json.dumps(fields).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def autoscaling_group_instances(ec2_client, group_name):
+    """Return the ids of the instances ec2 reports as members of an autoscaling group."""
+    instance_ids = []
+    paginator = ec2_client.get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=[{'Name': 'tag:aws:autoscaling:groupName', 'Values': [group_name]}]):
+        for reservation in page['Reservations']:
+            instance_ids.extend(instance['InstanceId'] for instance in reservation['Instances'])
+    return sorted(instance_ids)
+
+
+class FleetBaseline(object):
+    def __init__(self, result_store, instance_ids=None, plugins=None):
+        self.result_store = result_store
+        self.connection = result_store.connection
+        self.instance_ids = instance_ids
+        self.plugins = plugins or BASELINE_PLUGINS
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+            row = self.connection.execute('SELECT version FROM fingerprint_version').fetchone()
+            if row is None or row[0] != FINGERPRINT_VERSION:
+                logger.info('Fingerprints are out of date and will be recomputed.')
+                self.connection.execute('DELETE FROM fingerprints')
+                self.connection.execute('DELETE FROM fingerprint_labels')
+                self.connection.execute('DELETE FROM fingerprint_version')
+                self.connection.execute('INSERT INTO fingerprint_version (version) VALUES (?)', (FINGERPRINT_VERSION,))
+
+    def _plugin_clause(self, column):
+        clauses = []
+        params = []
+        for plugin in self.plugins:
+            if plugin.endswith(':'):
+                clauses.append('({0} >= ? AND {0} < ?)'.format(column))
+                params.extend([plugin, plugin[:-1] + ';'])
+            else:
+                clauses.append('{} = ?'.format(column))
+                params.append(plugin)
+        return '({})'.format(' OR '.join(clauses)), params
+
+    def update_fingerprints(self, batch_size=10000):
+        """Fingerprint result rows added since the last update.  Returns the number of rows hashed."""
+        with self.connection:
+            # Rows of re-ingested sources get new row ids, so drop fingerprints of the replaced ones.
+            self.connection.execute(
+                'DELETE FROM fingerprints WHERE row_id NOT IN (SELECT row_id FROM results)'
+            )
+        last_row_id = self.connection.execute('SELECT COALESCE(MAX(row_id), 0) FROM fingerprints').fetchone()[0]
+        plugin_clause, params = self._plugin_clause('plugin')
+        cursor = self.connection.execute(
+            'SELECT row_id, instance_id, plugin, data FROM results WHERE row_id > ? AND {} ORDER BY row_id'.format(
+                plugin_clause
+            ),
+            [last_row_id] + params
+        )
+
+        count = 0
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                break
+            fingerprints = []
+            labels = []
+            for row_id, instance_id, plugin, data in batch:
+                fields = stable_fields(json.loads(data))
+                value = fingerprint(fields)
+                fingerprints.append((row_id, instance_id, plugin, value))
+                labels.append((plugin, value, ', '.join('{}={}'.format(key, item) for key, item in fields)))
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO fingerprints (row_id, instance_id, plugin, fingerprint) VALUES (?, ?, ?, ?)',
+                    fingerprints
+                )
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO fingerprint_labels (plugin, fingerprint, label) VALUES (?, ?, ?)',
+                    labels
+                )
+            count += len(batch)
+        logger.info('Fingerprinted {} new result rows.'.format(count))
+        return count
+
+    def _load_fleet(self):
+        self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS fleet (instance_id TEXT PRIMARY KEY)')
+        self.connection.execute('DELETE FROM fleet')
+        if self.instance_ids is None:
+            self.connection.execute('INSERT INTO fleet SELECT DISTINCT instance_id FROM fingerprints')
+        else:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO fleet (instance_id) VALUES (?)', [(i,) for i in self.instance_ids]
+            )
+        # Per plugin, the number of fleet members that reported it and how many of them saw each fingerprint.
+        self.connection.execute('DROP TABLE IF EXISTS temp.fleet_plugins')
+        self.connection.execute(
+            """CREATE TEMP TABLE fleet_plugins AS
+            SELECT f.plugin AS plugin, COUNT(DISTINCT f.instance_id) AS instances
+            FROM fingerprints AS f JOIN fleet USING (instance_id)
+            GROUP BY f.plugin"""
+        )
+        self.connection.execute('DROP TABLE IF EXISTS temp.fleet_baseline')
+        self.connection.execute(
+            """CREATE TEMP TABLE fleet_baseline AS
+            SELECT f.plugin AS plugin, f.fingerprint AS fingerprint, COUNT(DISTINCT f.instance_id) AS instances
+            FROM fingerprints AS f JOIN fleet USING (instance_id)
+            GROUP BY f.plugin, f.fingerprint"""
+        )
+        self.connection.execute('CREATE INDEX temp.fleet_baseline_key ON fleet_baseline (plugin, fingerprint)')
+
+    def build(self):
+        """Refresh fingerprints and compute the frequency of every fingerprint across the fleet."""
+        self.update_fingerprints()
+        self._load_fleet()
+        # Members that were never ingested are not part of the comparison.
+        return self.connection.execute(
+            'SELECT COUNT(DISTINCT instance_id) FROM fingerprints JOIN fleet USING (instance_id)'
+        ).fetchone()[0]
+
+    def frequencies(self, plugin):
+        """Yield (label, instances, fleet_size) for each fingerprint of plugin, most common first."""
+        query = """SELECT l.label, b.instances, p.instances
+            FROM fleet_baseline AS b
+            JOIN fleet_plugins AS p ON p.plugin = b.plugin
+            JOIN fingerprint_labels AS l ON l.plugin = b.plugin AND l.fingerprint = b.fingerprint
+            WHERE b.plugin = ?
+            ORDER BY b.instances DESC"""
+        for row in self.connection.execute(query, (plugin,)):
+            yield row
+
+    def outliers(self, instance_id=None, threshold=None):
+        """Return rows whose fingerprint is seen on at most threshold of the fleet reporting that plugin."""
+        if threshold is None:
+            threshold = config('baseline_threshold', namespace='ssm_acquire', default='0.05', parser=float)
+        query = """SELECT DISTINCT f.instance_id, f.plugin, l.label, b.instances, p.instances
+            FROM fingerprints AS f
+            JOIN fleet USING (instance_id)
+            JOIN fleet_baseline AS b ON b.plugin = f.plugin AND b.fingerprint = f.fingerprint
+            JOIN fleet_plugins AS p ON p.plugin = f.plugin
+            JOIN fingerprint_labels AS l ON l.plugin = f.plugin AND l.fingerprint = f.fingerprint
+            WHERE CAST(b.instances AS REAL) / p.instances <= ?"""
+        params = [threshold]
+        if instance_id is not None:
+            query += ' AND f.instance_id = ?'
+            params.append(instance_id)
+        query += ' ORDER BY f.instance_id, f.plugin, b.instances'
+        return [
+            {
+                'instance_id': row[0],
+                'plugin': row[1],
+                'label': row[2],
+                'instances': row[3],
+                'fleet_size': row[4],
+                'frequency': float(row[3]) / row[4],
+            }
+            for row in self.connection.execute(query, params)
+        ]
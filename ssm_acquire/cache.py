@@ -0,0 +1,87 @@
+"""Memoization of analysis results keyed by everything that went into producing them."""
+import hashlib
+import json
+import os
+
+from logging import getLogger
+from ssm_acquire import metrics
+
+
+logger = getLogger(__name__)
+
+MANIFEST_NAME = 'analysis-manifest.json'
+CACHE_KEY_METADATA = 'ssm-acquire-cache-key'
+
+
+def digest_file(path, chunk_size=8 * 1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def cache_key(**parts):
+    """Return a stable key for a result from the inputs that produced it."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    """Tracks which outputs in /tmp/<instance_id> are current for a given cache key.
+
+    Outputs found in the asset bucket with a matching key in their object metadata are
+    downloaded instead of recomputed.
+    """
+
+    def __init__(self, instance_id, s3_manager=None):
+        self.instance_id = instance_id
+        self.s3_manager = s3_manager
+        self.directory = '/tmp/{}'.format(instance_id)
+        self.manifest_path = os.path.join(self.directory, MANIFEST_NAME)
+        self.manifest = {'digests': {}, 'results': {}}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as fh:
+                self.manifest.update(json.load(fh))
+
+    def save(self):
+        with open(self.manifest_path, 'w') as fh:
+            json.dump(self.manifest, fh, indent=2, sort_keys=True)
+
+    def file_digest(self, path):
+        """sha256 of a file, memoized by size and mtime so captures are only hashed once."""
+        stat = os.stat(path)
+        known = self.manifest['digests'].get(path)
+        if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+            return known['sha256']
+        logger.info('Hashing {} for the result cache.'.format(path))
+        with metrics.span('hash_file', path=path, size=stat.st_size):
+            digest = digest_file(path)
+        self.manifest['digests'][path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': digest}
+        self.save()
+        return digest
+
+    def is_current(self, output_name, key):
+        """True when output_name already holds the result for key, fetching it from the bucket if needed."""
+        local_path = os.path.join(self.directory, output_name)
+        if self.manifest['results'].get(output_name) == key and os.path.isfile(local_path):
+            logger.info('Result cache hit for: {}'.format(output_name))
+            metrics.increment('result_cache_hits_total', source='local')
+            return True
+
+        if self.s3_manager is not None:
+            object_key = '{}/{}'.format(self.instance_id, output_name)
+            metadata = self.s3_manager.get_metadata(object_key)
+            if metadata is not None and metadata.get(CACHE_KEY_METADATA) == key:
+                logger.info('Result cache hit in the asset store for: {}'.format(output_name))
+                self.s3_manager.get_files([{'Key': object_key}])
+                self.record(output_name, key)
+                metrics.increment('result_cache_hits_total', source='s3')
+                return True
+
+        logger.info('Result cache miss for: {}'.format(output_name))
+        metrics.increment('result_cache_misses_total')
+        return False
+
+    def record(self, output_name, key):
+        self.manifest['results'][output_name] = key
+        self.save()
@@ -13,83 +13,130 @@ from logging import INFO
 from logging import getLogger
 
 from ssm_acquire import analyze as da
+from ssm_acquire import baseline as fleet_baseline
 from ssm_acquire import common
 from ssm_acquire import credential
+from ssm_acquire import metrics
+from ssm_acquire import store
 
 config = common.get_config()
 basicConfig(level=INFO)
 logger = getLogger(__name__)
 
 
+def wait_for_command(ssm_client, logs_client, response, instance_id, spinner):
+    """Poll an ssm command until it leaves the pending states, streaming its output.  Return the final status."""
+    time.sleep(2)  # Wait for the command to register.
+    monitor = common.CommandMonitor(ssm_client, response, instance_id, logs_client)
+    with metrics.span('wait_for_command', instance_id=instance_id, command_id=monitor.command_id) as span:
+        status = monitor.poll()
+        while not status:
+            status = monitor.poll()
+            sys.stdout.write(next(spinner))
+            sys.stdout.flush()
+            sys.stdout.write('\b')
+            time.sleep(0.5)
+        span['attributes']['status'] = status
+        if monitor.cancelled_reason is not None:
+            span['attributes']['cancelled_reason'] = monitor.cancelled_reason
+    if monitor.progress:
+        logger.info('Last progress reported: {}'.format(monitor.progress))
+    return status
+
+
 @click.command()
 @click.option('--instance_id', help='The instance you would like to operate on.')
 @click.option('--region', default='us-west-2', help='The aws region where the instance can be found.')
 @click.option('--build', is_flag=True, help='Specify if you would like to build a rekall profile with this capture.')
 @click.option('--acquire', is_flag=True, help='Use linpmem to acquire a memory sample from the system in question.')
+@click.option('--sparse', is_flag=True, help='Upload the memory sample as a sparse, deduplicated and compressed image.')
 @click.option('--interrogate', is_flag=True, help='Use OSQuery binary to preserve top 10 type queries for rapid forensics.')
 @click.option('--analyze', is_flag=True, help='Use docker and rekall to autoanalyze the memory capture.')
+@click.option('--ingest', is_flag=True, help='Index the rekall and osquery results for the instance in the local results database.')
+@click.option('--baseline', is_flag=True, help='Report how the instance differs from every instance in the local results database.')
+@click.option('--fleet', 'fleet_members', default=None, help='Comma separated instance ids to compare the instance against with --baseline.')
+@click.option('--autoscaling-group', default=None, help='Compare the instance against the members of this autoscaling group with --baseline.')
 @click.option('--deploy', is_flag=True, help='Create a lambda function with a handler to take events from AWS GuardDuty.')
-def main(instance_id, region, build, acquire, interrogate, analyze, deploy):
+@click.option('--trace-file', default=None, help='Write spans, API call counts and transfer metrics to this json file.')
+@click.option('--metrics-port', default=None, type=int, help='Serve prometheus style metrics on localhost while running.')
+def main(instance_id, region, build, acquire, sparse, interrogate, analyze, ingest, baseline, fleet_members, autoscaling_group, deploy, trace_file,
+         metrics_port):
     """ssm_acquire a rapid evidence preservation tool for Amazon EC2."""
     logger.info('Initializing ssm_acquire.')
+    if metrics_port is not None:
+        metrics.recorder.serve(metrics_port)
+
+    try:
+        with metrics.span('ssm_acquire', instance_id=instance_id):
+            run_phases(instance_id, region, build, acquire, sparse, interrogate, analyze, ingest, baseline, fleet_members, autoscaling_group)
+    finally:
+        if trace_file is not None:
+            metrics.recorder.write(trace_file)
+    logger.info('ssm_acquire has completed successfully.')
+    return 0
 
-    if acquire is True or interrogate is True or build is True or analyze is True:
-        limited_scope_policy = common.get_limited_policy(region, instance_id)
-        logger.debug('Generating limited scoped policy for instance-id to be used in all operations: {}'.format(limited_scope_policy))
-        sts_manager = credential.StsManager(region_name=region, limited_scope_policy=limited_scope_policy)
-        credentials = sts_manager.auth()
-
-        ssm_client = boto3.client(
-            'ssm',
-            aws_access_key_id=credentials['Credentials']['AccessKeyId'],
-            aws_secret_access_key=credentials['Credentials']['SecretAccessKey'],
-            aws_session_token=credentials['Credentials']['SessionToken']
+
+def run_phases(instance_id, region, build, acquire, sparse, interrogate, analyze, ingest, baseline, fleet_members=None, autoscaling_group=None):
+    resolve_group = baseline is True and autoscaling_group is not None
+    if acquire is True or interrogate is True or build is True or analyze is True or ingest is True or resolve_group:
+        with metrics.span('auth', instance_id=instance_id):
+            limited_scope_policy = common.get_limited_policy(region, instance_id)
+            logger.debug('Generating limited scoped policy for instance-id to be used in all operations: {}'.format(limited_scope_policy))
+            sts_manager = credential.StsManager(region_name=region, limited_scope_policy=limited_scope_policy)
+            credentials = sts_manager.auth()
+
+        ssm_client = metrics.instrument_client(
+            boto3.client(
+                'ssm',
+                aws_access_key_id=credentials['Credentials']['AccessKeyId'],
+                aws_secret_access_key=credentials['Credentials']['SecretAccessKey'],
+                aws_session_token=credentials['Credentials']['SessionToken']
+            )
+        )
+        logs_client = metrics.instrument_client(
+            boto3.client(
+                'logs',
+                aws_access_key_id=credentials['Credentials']['AccessKeyId'],
+                aws_secret_access_key=credentials['Credentials']['SecretAccessKey'],
+                aws_session_token=credentials['Credentials']['SessionToken']
+            )
         )
 
     spinner = itertools.cycle(['-', '/', '|', '\\'])
 
     if analyze is True:
         logger.info('Analysis mode active.')
-        analyzer = da.RekallManager(
-            instance_id,
-            credentials
-        )
+        with metrics.span('analyze', instance_id=instance_id):
+            analyzer = da.RekallManager(
+                instance_id,
+                credentials
+            )
 
-        analyzer.download_incident_data()
-        analyzer.run_rekall_plugins()
+            # Yara triage reads the capture in place, so it runs before the capture is downloaded.
+            with metrics.span('native_yara_scan', instance_id=instance_id):
+                scanned = analyzer.run_native_yara_scan()
+            with metrics.span('download_incident_data', instance_id=instance_id):
+                analyzer.download_incident_data()
+            analyzer.run_rekall_plugins(yara=not scanned)
         logger.info('Analysis complete.  The rekall-json dumps have been added to the asset store.')
 
     if acquire is True:
         commands = common.load_acquire()['distros']['amzn2']['commands']  # Only supports amzn2 for now
         # XXX TBD add a distro resolver and replace amzn2 with a dynamic distro.
         try:
-            response = common.run_command(ssm_client, commands, instance_id)
-            time.sleep(2)  # Wait for the command to register.
-            status = common.check_status(ssm_client, response, instance_id)
-            logger.info('Memory dump in progress for instance: {}.  Please wait.'.format(instance_id))
-            while not status:
-                status = common.check_status(ssm_client, response, instance_id)
-                sys.stdout.write(next(spinner))
-                sys.stdout.flush()
-                sys.stdout.write('\b')
-                time.sleep(0.5)
-
-            status = 'Success'
+            with metrics.span('acquire', instance_id=instance_id):
+                response = common.run_command(ssm_client, commands, instance_id)
+                logger.info('Memory dump in progress for instance: {}.  Please wait.'.format(instance_id))
+                status = wait_for_command(ssm_client, logs_client, response, instance_id, spinner)
 
             if status == 'Success':
                 logger.info('The task completed with status: {}'.format(status))
                 logger.info('Proceeding to copy off the data to the asset store.')
-                transfer_plan = common.load_transfer(credentials, instance_id)['distros']['amzn2']['commands']
-                response = common.run_command(ssm_client, transfer_plan, instance_id)
-                time.sleep(2)
-                logger.info('Copying the asset to s3 bucket for preservation.')
-                status = common.check_status(ssm_client, response, instance_id)
-                while not status:
-                    status = common.check_status(ssm_client, response, instance_id)
-                    sys.stdout.write(next(spinner))
-                    sys.stdout.flush()
-                    sys.stdout.write('\b')
-                    time.sleep(0.5)
+                with metrics.span('transfer', instance_id=instance_id, sparse=sparse):
+                    transfer_plan = common.load_transfer(credentials, instance_id, sparse)['distros']['amzn2']['commands']
+                    response = common.run_command(ssm_client, transfer_plan, instance_id)
+                    logger.info('Copying the asset to s3 bucket for preservation.')
+                    status = wait_for_command(ssm_client, logs_client, response, instance_id, spinner)
                 logger.info('Transfer sequence complete.')
             else:
                 logger.error('The task did not complete status: {}'.format(status))
@@ -97,18 +144,12 @@ def main(instance_id, region, build, acquire, interrogate, analyze, deploy):
             logger.error('The task could no be completed due to: {}'.format(e))
 
     if build is True:
-        build_plan = common.load_build(credentials, instance_id)['distros']['amzn2']['commands']
-        logger.info('Attempting to build a rekall profile for instance: {}.'.format(instance_id))
-        response = common.run_command(ssm_client, build_plan, instance_id)
-        logger.info('An attempt to build a rekall profile has begun.  Please wait.')
-        time.sleep(2)
-        status = common.check_status(ssm_client, response, instance_id)
-        while not status:
-            status = common.check_status(ssm_client, response, instance_id)
-            sys.stdout.write(next(spinner))
-            sys.stdout.flush()
-            sys.stdout.write('\b')
-            time.sleep(0.5)
+        with metrics.span('build', instance_id=instance_id):
+            build_plan = common.load_build(credentials, instance_id)['distros']['amzn2']['commands']
+            logger.info('Attempting to build a rekall profile for instance: {}.'.format(instance_id))
+            response = common.run_command(ssm_client, build_plan, instance_id)
+            logger.info('An attempt to build a rekall profile has begun.  Please wait.')
+            status = wait_for_command(ssm_client, logs_client, response, instance_id, spinner)
         if status == 'Success':
             logger.info(
                 'Rekall profile build complete. A .zip has been added to the asset store for instance: {}'.format(
@@ -119,21 +160,15 @@ def main(instance_id, region, build, acquire, interrogate, analyze, deploy):
             logger.error('Rekall profile build failure.')
 
     if interrogate is True:
-        interrogate_plan = common.load_interrogate(credentials, instance_id)['distros']['amzn2']['commands']
-        logger.info(
-            'Attemping to interrogate the instance using the OSQuery binary for instance_id: {}'.format(
-                instance_id
+        with metrics.span('interrogate', instance_id=instance_id):
+            interrogate_plan = common.load_interrogate(credentials, instance_id)['distros']['amzn2']['commands']
+            logger.info(
+                'Attemping to interrogate the instance using the OSQuery binary for instance_id: {}'.format(
+                    instance_id
+                )
             )
-        )
-        response = common.run_command(ssm_client, interrogate_plan, instance_id)
-        time.sleep(2)
-        status = common.check_status(ssm_client, response, instance_id)
-        while not status:
-            status = common.check_status(ssm_client, response, instance_id)
-            sys.stdout.write(next(spinner))
-            sys.stdout.flush()
-            sys.stdout.write('\b')
-            time.sleep(0.5)
+            response = common.run_command(ssm_client, interrogate_plan, instance_id)
+            status = wait_for_command(ssm_client, logs_client, response, instance_id, spinner)
         if status == 'Success':
             logger.info(
                 'Interrogation of system complete.  The result of this has been added to asset store for: {}'.format(
@@ -142,8 +177,50 @@ def main(instance_id, region, build, acquire, interrogate, analyze, deploy):
             )
         else:
             logger.error('Instance interrogation failure.')
-    logger.info('ssm_acquire has completed successfully.')
-    return 0
+
+    if ingest is True:
+        logger.info('Indexing results for instance: {} in the results database.'.format(instance_id))
+        with metrics.span('ingest', instance_id=instance_id):
+            s3_manager = da.S3Manager(credentials, config('asset_bucket', namespace='ssm_acquire'))
+            result_dir, capture_times = store.fetch_results(s3_manager, instance_id)
+            result_store = store.ResultStore()
+            count = result_store.ingest_directory(result_dir, instance_id, capture_times)
+            result_store.close()
+        metrics.increment('rows_ingested_total', count)
+        logger.info('Ingestion complete.  {} new rows were added to: {}'.format(count, result_store.db_path))
+
+    if baseline is True:
+        with metrics.span('baseline', instance_id=instance_id):
+            instance_ids = None
+            if fleet_members is not None:
+                instance_ids = [member.strip() for member in fleet_members.split(',') if member.strip()]
+            if resolve_group:
+                ec2_client = metrics.instrument_client(
+                    boto3.client(
+                        'ec2',
+                        region_name=region,
+                        aws_access_key_id=credentials['Credentials']['AccessKeyId'],
+                        aws_secret_access_key=credentials['Credentials']['SecretAccessKey'],
+                        aws_session_token=credentials['Credentials']['SessionToken']
+                    )
+                )
+                instance_ids = (instance_ids or []) + fleet_baseline.autoscaling_group_instances(ec2_client, autoscaling_group)
+                logger.info('Autoscaling group {} has {} instances.'.format(autoscaling_group, len(instance_ids)))
+            if instance_ids is not None and instance_id not in instance_ids:
+                instance_ids.append(instance_id)
+
+            result_store = store.ResultStore()
+            fleet = fleet_baseline.FleetBaseline(result_store, instance_ids=instance_ids)
+            fleet_size = fleet.build()
+            outliers = fleet.outliers(instance_id)
+            result_store.close()
+        logger.info('Comparing instance: {} against a fleet of {} instances.'.format(instance_id, fleet_size))
+        for outlier in outliers:
+            logger.info(
+                'Outlier in {}: {} (seen on {} of {} instances)'.format(
+                    outlier['plugin'], outlier['label'], outlier['instances'], outlier['fleet_size']
+                )
+            )
 
 
 if __name__ == "__main__":
@@ -1,15 +1,22 @@
+import base64
 import os
 import json
+import re
 import yaml
+from botocore.exceptions import ClientError
+from collections import OrderedDict
 from everett.ext.inifile import ConfigIniEnv
 from everett.manager import ConfigManager
 from everett.manager import ConfigOSEnv
 from jinja2 import Template
 from logging import getLogger
+from ssm_acquire import metrics
 
 
 logger = getLogger(__name__)
 
+COMMAND_LOG_GROUP = '/ssm-acquire/commands'
+
 
 def get_config():
     return ConfigManager(
@@ -30,9 +37,19 @@ def load_acquire():
     return yaml.safe_load(open(path))
 
 
-def load_transfer(credentials, instance_id):
+def load_packer():
+    """Return the sparse image packer as base64 so a plan can write it onto the instance."""
     this_path = os.path.abspath(os.path.dirname(__file__))
-    path = os.path.join(this_path, "transfer-plans/linpmem.yml.j2")
+    with open(os.path.join(this_path, "sparse.py"), 'rb') as fh:
+        return base64.b64encode(fh.read()).decode('ascii')
+
+
+def load_transfer(credentials, instance_id, sparse=False):
+    this_path = os.path.abspath(os.path.dirname(__file__))
+    if sparse:
+        path = os.path.join(this_path, "transfer-plans/sparse.yml.j2")
+    else:
+        path = os.path.join(this_path, "transfer-plans/linpmem.yml.j2")
     config = get_config()
 
     fh = open(path)
@@ -45,7 +62,8 @@ def load_transfer(credentials, instance_id):
         ssm_acquire_secret_key=credentials['Credentials']['SecretAccessKey'],
         ssm_acquire_session_token=credentials['Credentials']['SessionToken'],
         ssm_acquire_s3_bucket=s3_bucket,
-        ssm_acquire_instance_id=instance_id
+        ssm_acquire_instance_id=instance_id,
+        ssm_acquire_packer=load_packer() if sparse else None
 
     )
     return yaml.safe_load(transfer_plan)
@@ -124,38 +142,219 @@ def get_limited_policy(region, instance_id):
             record_index = policy_template['PolicyDocument']['Statement'].index(permission)
             policy_template['PolicyDocument']['Statement'][record_index]['Resource'][0] = s3_arn
             policy_template['PolicyDocument']['Statement'][record_index]['Resource'][1] = s3_keys
+        elif permission['Sid'] == 'STMT5':
+            log_group = config('command_log_group', namespace='ssm_acquire', default=COMMAND_LOG_GROUP)
+            record_index = policy_template['PolicyDocument']['Statement'].index(permission)
+            policy_template['PolicyDocument']['Statement'][record_index]['Resource'][0] = \
+                'arn:aws:logs:*:*:log-group:{}:*'.format(log_group)
     statements = json.dumps(policy_template['PolicyDocument'])
     logger.info('Limited scope role generated for assumeRole: {}'.format(statements))
     return statements
 
 
 def run_command(client, commands, instance_id):
-    """Run an ssm command.  Return the boto3 response."""
+    """Run an ssm command.  Return the boto3 response.
+
+    Output is sent to cloudwatch logs as the command runs so CommandMonitor can stream it.  With
+    command_output_to_s3 the full stdout and stderr are also kept under <instance_id>/ssm-output/.
+    """
     # XXX TBD add a test to see if another invocation is pending and raise if waiting.
+    config = get_config()
+    kwargs = {}
+    if config('command_output_to_s3', namespace='ssm_acquire', default='false', parser=bool):
+        kwargs['OutputS3BucketName'] = config('asset_bucket', namespace='ssm_acquire')
+        kwargs['OutputS3KeyPrefix'] = '{}/ssm-output'.format(instance_id)
+    if config('command_output_to_cloudwatch', namespace='ssm_acquire', default='true', parser=bool):
+        kwargs['CloudWatchOutputConfig'] = {
+            'CloudWatchLogGroupName': config('command_log_group', namespace='ssm_acquire', default=COMMAND_LOG_GROUP),
+            'CloudWatchOutputEnabled': True
+        }
     response = client.send_command(
         InstanceIds=[instance_id],
         DocumentName='AWS-RunShellScript',
         Comment='Incident response step execution for: {}'.format(instance_id),
         Parameters={
             "commands": commands
-        }
+        },
+        **kwargs
     )
     return response
 
 
-def check_status(client, response, instance_id):
-    logger.debug('Attempting to retrieve status for command_id: {}'.format(response['Command']['CommandId']))
-    response = client.get_command_invocation(
-        CommandId=response['Command']['CommandId'],
-        InstanceId=instance_id
-    )
+PENDING_STATUSES = ['Pending', 'InProgress', 'Delayed', 'Cancelling']
 
-    if response['Status'] == 'Pending':
-        return None
-    if response['Status'] == 'InProgress':
-        return None
-    if response['Status'] == 'Delayed':
-        return None
-    if response['Status'] == 'Cancelling':
+# The most polls skipped before reading throttled log streams again.
+MAX_THROTTLED_POLLS = 8
+
+# Output that means the rest of a plan cannot succeed.
+FATAL_PATTERNS = [
+    r'No space left on device',
+    r'Cannot allocate memory',
+    r'No package \S+ available',
+    r'Error: Unable to find a match',
+    r'fatal: ',
+    r'make: \*\*\*',
+    r'command not found',
+]
+
+# Progress reports of the tools the plans run: aws s3 cp, wget and linpmem.
+PROGRESS_PATTERNS = [
+    re.compile(r'Completed (?P<done>[\d.]+ ?[KMGT]i?B)/(?P<total>[\d.]+ ?[KMGT]i?B)'),
+    re.compile(r'(?P<percent>\d{1,3})%'),
+    re.compile(r'(?P<done>\d+(?:\.\d+)? ?[KMGT]i?B) (?:written|read|copied|imaged)', re.IGNORECASE),
+]
+
+# The invocation fields holding the output of each cloudwatch log stream the agent writes.
+OUTPUT_STREAMS = OrderedDict([('stdout', 'StandardOutputContent'), ('stderr', 'StandardErrorContent')])
+
+
+class CommandMonitor(object):
+    """Polls a running ssm command and streams its output as it arrives.
+
+    get_command_invocation only returns output once the command has finished, so while it runs
+    the output is tailed from the cloudwatch log streams the agent writes when the command was
+    sent with a CloudWatchOutputConfig.  Progress reports are logged as they are parsed, and the
+    command is cancelled as soon as its output matches one of fatal_patterns.  Without a
+    logs_client, or when the log streams cannot be read, the inline output is handled when the
+    command finishes, as is any inline output beyond what the log streams had caught up to.
+    """
+
+    def __init__(self, client, response, instance_id, logs_client=None, fatal_patterns=None):
+        self.client = client
+        self.logs_client = logs_client
+        self.command_id = response['Command']['CommandId']
+        self.instance_id = instance_id
+        self.fatal_patterns = [re.compile(pattern) for pattern in (fatal_patterns or FATAL_PATTERNS)]
+
+        cloudwatch_config = response['Command'].get('CloudWatchOutputConfig', {})
+        self.log_group_name = None
+        if cloudwatch_config.get('CloudWatchOutputEnabled'):
+            self.log_group_name = cloudwatch_config.get('CloudWatchLogGroupName')
+
+        self.tokens = {'stdout': None, 'stderr': None}
+        self.partial = {'stdout': '', 'stderr': ''}
+        self.tailed = {'stdout': 0, 'stderr': 0}
+        self.throttled_polls = 0
+        self.skip_polls = 0
+        self.progress = None
+        self.cancelled_reason = None
+
+    def poll(self):
+        """Fetch the invocation, handle any new output and return the status, or None while running."""
+        logger.debug('Attempting to retrieve status for command_id: {}'.format(self.command_id))
+        invocation = self.client.get_command_invocation(
+            CommandId=self.command_id,
+            InstanceId=self.instance_id
+        )
+        status = invocation['Status']
+        metrics.increment('command_polls_total', status=status)
+        finished = status not in PENDING_STATUSES
+
+        if finished:
+            # The last poll drains the log streams once more before the inline output is considered.
+            self.skip_polls = 0
+        elif self.skip_polls:
+            self.skip_polls -= 1
+            return None
+        for stream, content_field in OUTPUT_STREAMS.items():
+            if self.logs_client is not None and self.log_group_name is not None and not self.skip_polls:
+                self._tail(stream)
+            if finished:
+                # CloudWatch lags the command, so output the tail has not seen yet comes from the inline copy.
+                inline_output = invocation.get(content_field, '')
+                self._consume(stream, inline_output[self.tailed[stream]:], finished)
+
+        if finished:
+            return status
         return None
-    return response['Status']
+
+    def _log_stream_name(self, stream):
+        return '{}/{}/aws-runShellScript/{}'.format(self.command_id, self.instance_id, stream)
+
+    def _tail(self, stream):
+        """Handle the cloudwatch log events of stream added since the last poll."""
+        while True:
+            kwargs = {}
+            if self.tokens[stream] is not None:
+                kwargs['nextToken'] = self.tokens[stream]
+            try:
+                response = self.logs_client.get_log_events(
+                    logGroupName=self.log_group_name,
+                    logStreamName=self._log_stream_name(stream),
+                    startFromHead=True,
+                    **kwargs
+                )
+            except ClientError as e:
+                code = e.response['Error']['Code']
+                if code == 'ResourceNotFoundException':
+                    # The agent creates the stream when the command first writes to it.
+                    return
+                if code in ('AccessDenied', 'AccessDeniedException'):
+                    logger.warning(
+                        'Could not read command output from cloudwatch logs due to: {}.  '
+                        'Output will be shown when the command finishes.'.format(e)
+                    )
+                    self.logs_client = None
+                elif code == 'ThrottlingException':
+                    self.throttled_polls = min(self.throttled_polls * 2 or 1, MAX_THROTTLED_POLLS)
+                    self.skip_polls = self.throttled_polls
+                    logger.debug('Reading command output was throttled, skipping {} polls.'.format(self.skip_polls))
+                else:
+                    logger.warning('Could not read command output from cloudwatch logs due to: {}.  Retrying.'.format(e))
+                return
+
+            self.throttled_polls = 0
+            for event in response['events']:
+                output = event['message'] + '\n'
+                self.tailed[stream] += len(output)
+                self._consume(stream, output)
+            if not response['events'] or response['nextForwardToken'] == self.tokens[stream]:
+                self.tokens[stream] = response['nextForwardToken']
+                return
+            self.tokens[stream] = response['nextForwardToken']
+
+    def _consume(self, stream, output, finished=False):
+        if output:
+            metrics.increment('command_output_bytes_total', len(output), stream=stream)
+        lines = (self.partial[stream] + output).split('\n')
+        if finished:
+            self.partial[stream] = ''
+        else:
+            self.partial[stream] = lines.pop()
+
+        for line in lines:
+            # Tools like wget redraw progress with carriage returns, keep the latest report.
+            line = line.rstrip('\r').split('\r')[-1]
+            if not line:
+                continue
+            self._parse_progress(line)
+            logger.info('[{}] {}'.format(self.instance_id, line))
+            # There is nothing left to cancel once the command has finished.
+            if self.cancelled_reason is None and not finished:
+                for pattern in self.fatal_patterns:
+                    if pattern.search(line):
+                        self.cancel(line)
+                        break
+
+    def _parse_progress(self, line):
+        for pattern in PROGRESS_PATTERNS:
+            match = pattern.search(line)
+            if match:
+                self.progress = match.groupdict()
+                return
+
+    def cancel(self, reason):
+        """Cancel the command.  A failure to cancel is logged and the command left to run."""
+        logger.error(
+            'Cancelling command: {} on instance: {} due to output: {}'.format(self.command_id, self.instance_id, reason)
+        )
+        try:
+            self.client.cancel_command(
+                CommandId=self.command_id,
+                InstanceIds=[self.instance_id]
+            )
+        except ClientError as e:
+            logger.error('Could not cancel command: {} due to: {}'.format(self.command_id, e))
+            return
+        self.cancelled_reason = reason
+        metrics.increment('commands_cancelled_total')
@@ -3,6 +3,7 @@ import boto3
 from logging import getLogger
 from prompt_toolkit import prompt
 
+from ssm_acquire import metrics
 from ssm_acquire.common import get_config
 
 
@@ -13,7 +14,7 @@ logger = getLogger(__name__)
 class StsManager(object):
     def __init__(self, region_name, limited_scope_policy):
         self.boto_session = boto3.session.Session(region_name=region_name)
-        self.sts_client = self.boto_session.client('sts')
+        self.sts_client = metrics.instrument_client(self.boto_session.client('sts'))
         self.limited_scope_policy = limited_scope_policy
 
     def auth(self):
@@ -46,7 +47,7 @@ class StsManager(object):
                     config('mfa_serial_number', namespace='ssm_acquire', default='None')
                 )
             )
-            return self.get_session_token()
+            return self.get_session_token(self.sts_client)
 
     def _should_mfa(self):
         if config('mfa_serial_number', namespace='ssm_acquire', default='None') != 'None':
@@ -61,9 +62,10 @@ class StsManager(object):
             return False
 
     def get_session_token_with_mfa(self, client):
-        token_code = prompt('Please enter your MFA Token: ')
+        with metrics.span('mfa_prompt'):
+            token_code = prompt('Please enter your MFA Token: ')
         response = client.get_session_token(
-            DurationSeconds=config('assume_role_session_duration', default='3600', namespace='ssm_acquire'),
+            DurationSeconds=config('assume_role_session_duration', default='3600', namespace='ssm_acquire', parser=int),
             SerialNumber=config('mfa_serial_number', namespace='ssm_acquire', default='None'),
             TokenCode=token_code
         )
@@ -71,7 +73,7 @@ class StsManager(object):
 
     def get_session_token(self, client):
         response = client.get_session_token(
-            DurationSeconds=config('assume_role_session_duration', default='3600', namespace='ssm_acquire')
+            DurationSeconds=config('assume_role_session_duration', default='3600', namespace='ssm_acquire', parser=int)
         )
         return response
 
@@ -85,7 +87,8 @@ class StsManager(object):
         return response
 
     def assume_role_with_mfa(self, client, role_arn):
-        token_code = prompt('Please enter your MFA Token: ')
+        with metrics.span('mfa_prompt'):
+            token_code = prompt('Please enter your MFA Token: ')
         response = client.assume_role(
             RoleArn=role_arn,
             RoleSessionName='ssm-acquire',
@@ -0,0 +1,189 @@
+"""Spans, counters and timers for each phase of an ssm_acquire run."""
+import itertools
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+PREFIX = 'ssm_acquire'
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Recorder(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._ids = itertools.count(1)
+            self.started = time.time()
+            self.spans = []
+            self.counters = {}
+            self.timers = {}
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time the enclosed block.  Nested spans record the enclosing span as their parent."""
+        stack = self._stack()
+        record = {
+            'id': next(self._ids),
+            'parent': stack[-1]['id'] if stack else None,
+            'name': name,
+            'start': time.time(),
+            'duration': None,
+            'status': 'ok',
+            'attributes': attributes
+        }
+        stack.append(record)
+        began = time.monotonic()
+        try:
+            yield record
+        except BaseException:
+            record['status'] = 'error'
+            raise
+        finally:
+            record['duration'] = time.monotonic() - began
+            stack.pop()
+            with self._lock:
+                self.spans.append(record)
+            self.observe('span_seconds', record['duration'], span=name)
+
+    def increment(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            count, total, longest = self.timers.get(key, (0, 0.0, 0.0))
+            self.timers[key] = (count + 1, total + seconds, max(longest, seconds))
+
+    def instrument_client(self, client):
+        """Count and time every API call made by a boto3 client."""
+        service = client.meta.service_model.service_name
+
+        def before_call(model, context, **kwargs):
+            context['ssm_acquire_started'] = time.monotonic()
+
+        def after_call(model, context, http_response=None, **kwargs):
+            started = context.get('ssm_acquire_started')
+            status = getattr(http_response, 'status_code', None)
+            self.increment('api_calls_total', service=service, operation=model.name, status=status)
+            if started is not None:
+                self.observe('api_call_seconds', time.monotonic() - started, service=service, operation=model.name)
+
+        client.meta.events.register('before-call', before_call)
+        client.meta.events.register('after-call', after_call)
+        return client
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'started': self.started,
+                'spans': sorted(self.spans, key=lambda span: span['id']),
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'timers': [
+                    {'name': name, 'labels': dict(labels), 'count': count, 'sum': total, 'max': longest}
+                    for (name, labels), (count, total, longest) in sorted(self.timers.items())
+                ],
+                'cache_hit_rates': {
+                    'result_cache': self._unlocked_rate('result_cache_hits_total', 'result_cache_misses_total'),
+                    'capture_block_cache': self._unlocked_rate(
+                        'capture_block_cache_hits_total', 'capture_block_cache_misses_total'
+                    )
+                }
+            }
+
+    def _unlocked_rate(self, hits_name, misses_name):
+        hits = sum(value for (name, _), value in self.counters.items() if name == hits_name)
+        misses = sum(value for (name, _), value in self.counters.items() if name == misses_name)
+        if hits + misses == 0:
+            return None
+        return float(hits) / (hits + misses)
+
+    def write(self, path):
+        with open(path, 'w') as fh:
+            json.dump(self.to_dict(), fh, indent=2, default=str)
+        logger.info('Trace written to: {}'.format(path))
+
+    def prometheus_text(self):
+        """Render counters and timers in the Prometheus text exposition format."""
+        def render_labels(labels):
+            if not labels:
+                return ''
+            return '{{{}}}'.format(
+                ','.join('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels)
+            )
+
+        lines = []
+        with self._lock:
+            seen = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = '{}_{}'.format(PREFIX, name)
+                if metric not in seen:
+                    lines.append('# TYPE {} counter'.format(metric))
+                    seen.add(metric)
+                lines.append('{}{} {}'.format(metric, render_labels(labels), value))
+            for (name, labels), (count, total, _) in sorted(self.timers.items()):
+                metric = '{}_{}'.format(PREFIX, name)
+                if metric not in seen:
+                    lines.append('# TYPE {} summary'.format(metric))
+                    seen.add(metric)
+                lines.append('{}_count{} {}'.format(metric, render_labels(labels), count))
+                lines.append('{}_sum{} {}'.format(metric, render_labels(labels), total))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, address='127.0.0.1'):
+        """Expose prometheus_text() on http://address:port/metrics from a daemon thread."""
+        recorder = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = recorder.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        server = HTTPServer((address, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, name='ssm-acquire-metrics')
+        thread.daemon = True
+        thread.start()
+        logger.info('Serving metrics on http://{}:{}/metrics'.format(address, server.server_port))
+        return server
+
+
+recorder = Recorder()
+
+span = recorder.span
+increment = recorder.increment
+observe = recorder.observe
+instrument_client = recorder.instrument_client
@@ -0,0 +1,159 @@
+"""File-like access to captures in the asset store without downloading them first."""
+import io
+import threading
+
+from collections import OrderedDict
+from logging import getLogger
+from ssm_acquire import common
+from ssm_acquire import metrics
+
+
+config = common.get_config()
+logger = getLogger(__name__)
+
+MIB = 1024 * 1024
+
+
+class S3RangeReader(io.RawIOBase):
+    """Read-only, seekable view of an S3 object backed by ranged GETs.
+
+    Blocks are fetched on demand and held in an LRU cache bounded by cache_bytes.
+    When reads walk the object sequentially the next prefetch_blocks blocks are
+    pulled in a single ranged request so scans are not bound by request latency.
+    """
+
+    def __init__(self, s3_client, bucket_name, object_key, size=None, block_size=None, cache_bytes=None, prefetch_blocks=None):
+        super(S3RangeReader, self).__init__()
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.object_key = object_key
+
+        if block_size is None:
+            block_size = config('capture_block_size', namespace='ssm_acquire', default=str(MIB), parser=int)
+        if cache_bytes is None:
+            cache_bytes = config('capture_cache_bytes', namespace='ssm_acquire', default=str(256 * MIB), parser=int)
+        if prefetch_blocks is None:
+            prefetch_blocks = config('capture_prefetch_blocks', namespace='ssm_acquire', default='8', parser=int)
+
+        self.block_size = block_size
+        self.max_cached_blocks = max(1, cache_bytes // block_size)
+        self.prefetch_blocks = prefetch_blocks
+
+        self.etag = None
+        self.size = size if size is not None else self._head_size()
+        self.position = 0
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_block = None
+
+        self.requests = 0
+        self.bytes_fetched = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _head_size(self):
+        response = self.s3_client.head_object(
+            Bucket=self.bucket_name,
+            Key=self.object_key
+        )
+        self.etag = response.get('ETag')
+        return response['ContentLength']
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('Invalid whence: {}'.format(whence))
+        if position < 0:
+            raise ValueError('Negative seek position: {}'.format(position))
+        self.position = position
+        return self.position
+
+    def readinto(self, buffer):
+        data = self.read_at(self.position, len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(0, self.size - self.position)
+        data = self.read_at(self.position, size)
+        self.position += len(data)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def read_at(self, offset, size):
+        """Return up to size bytes starting at offset without moving the file position."""
+        if offset >= self.size or size <= 0:
+            return b''
+        end = min(offset + size, self.size)
+        first_block = offset // self.block_size
+        last_block = (end - 1) // self.block_size
+
+        chunks = []
+        for index in range(first_block, last_block + 1):
+            block = self._get_block(index)
+            block_start = index * self.block_size
+            chunks.append(block[max(offset, block_start) - block_start:end - block_start])
+        return b''.join(chunks)
+
+    def _get_block(self, index):
+        with self._lock:
+            block = self._cache.get(index)
+            if block is not None:
+                self._cache.move_to_end(index)
+                self.hits += 1
+                metrics.increment('capture_block_cache_hits_total')
+                self._last_block = index
+                return block
+
+            self.misses += 1
+            metrics.increment('capture_block_cache_misses_total')
+            count = 1
+            if self._last_block is not None and index == self._last_block + 1:
+                count += self.prefetch_blocks
+            count = min(count, self._block_count() - index, self.max_cached_blocks)
+            self._fetch_blocks(index, count)
+            self._last_block = index
+            return self._cache[index]
+
+    def _block_count(self):
+        return (self.size + self.block_size - 1) // self.block_size
+
+    def _fetch_blocks(self, index, count):
+        start = index * self.block_size
+        end = min((index + count) * self.block_size, self.size) - 1
+        logger.debug('Fetching bytes {}-{} of s3://{}/{}'.format(start, end, self.bucket_name, self.object_key))
+        response = self.s3_client.get_object(
+            Bucket=self.bucket_name,
+            Key=self.object_key,
+            Range='bytes={}-{}'.format(start, end)
+        )
+        data = response['Body'].read()
+        self.requests += 1
+        self.bytes_fetched += len(data)
+        metrics.increment('capture_bytes_fetched_total', len(data))
+
+        for offset in range(0, len(data), self.block_size):
+            self._cache[index] = data[offset:offset + self.block_size]
+            self._cache.move_to_end(index)
+            index += 1
+        while len(self._cache) > self.max_cached_blocks:
+            self._cache.popitem(last=False)
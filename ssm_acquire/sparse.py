@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""Sparse, deduplicated and chunk compressed memory images.
+
+This module only uses the standard library, and pack() stays python 2 compatible, because
+the transfer plan copies it onto the instance to package a capture before upload::
+
+    python sparse.py pack capture.raw capture.sparse
+
+Layout of a sparse image:
+
+* A fixed size header.
+* Chunks of pages_per_chunk unique pages, each zlib compressed on its own.
+* The page map, one little endian uint32 per page of the original image.  0 is an elided
+  zero page, n is the unique page n - 1.
+* The chunk index, one little endian uint64 file offset per chunk plus the end offset.
+* A fixed size trailer locating the map and index and holding the sha256 of the original image.
+"""
+from __future__ import print_function
+
+import hashlib
+import io
+import struct
+import sys
+import zlib
+
+from array import array
+from collections import OrderedDict
+
+
+MAGIC = b'SSMSPRS1'
+VERSION = 1
+HEADER = struct.Struct('<8sIII')
+TRAILER = struct.Struct('<QQQQQQ32s8s')
+
+PAGE_SIZE = 4096
+PAGES_PER_CHUNK = 256
+MAX_DEDUP_PAGES = 1 << 20
+
+
+def _to_bytes(values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+
+def _from_bytes(typecode, data):
+    values = array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def _uint32_array():
+    for typecode in ('I', 'L'):
+        if array(typecode).itemsize == 4:
+            return typecode
+    raise RuntimeError('No 4 byte unsigned array type available.')
+
+
+def _uint64_array():
+    for typecode in ('L', 'Q'):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            continue
+    raise RuntimeError('No 8 byte unsigned array type available.')
+
+
+def _read_exactly(fh, size):
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = fh.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def pack(source, destination, page_size=PAGE_SIZE, pages_per_chunk=PAGES_PER_CHUNK,
+         level=1, max_dedup_pages=MAX_DEDUP_PAGES):
+    """Package the flat image read sequentially from source into destination.
+
+    Both arguments are binary file objects; source may be a pipe.  Returns a dict of statistics.
+    """
+    zero_page = b'\x00' * page_size
+    page_map = array(_uint32_array())
+    chunk_offsets = array(_uint64_array())
+    known_pages = {}
+    pending = []
+    image_digest = hashlib.sha256()
+    image_size = 0
+    unique_pages = 0
+    zero_pages = 0
+
+    destination.write(HEADER.pack(MAGIC, VERSION, page_size, pages_per_chunk))
+    offset = HEADER.size
+
+    def flush():
+        data = zlib.compress(b''.join(pending), level)
+        chunk_offsets.append(offset)
+        destination.write(data)
+        del pending[:]
+        return offset + len(data)
+
+    while True:
+        page = _read_exactly(source, page_size)
+        if not page:
+            break
+        image_digest.update(page)
+        image_size += len(page)
+        if len(page) < page_size:
+            page += b'\x00' * (page_size - len(page))
+
+        if page == zero_page:
+            page_map.append(0)
+            zero_pages += 1
+            continue
+
+        page_digest = hashlib.sha256(page).digest()
+        page_id = known_pages.get(page_digest)
+        if page_id is None:
+            page_id = unique_pages
+            unique_pages += 1
+            pending.append(page)
+            if len(known_pages) < max_dedup_pages:
+                known_pages[page_digest] = page_id
+            if len(pending) == pages_per_chunk:
+                offset = flush()
+        page_map.append(page_id + 1)
+
+    if pending:
+        offset = flush()
+    chunk_offsets.append(offset)
+
+    map_data = zlib.compress(_to_bytes(page_map), level)
+    index_data = zlib.compress(_to_bytes(chunk_offsets), level)
+    destination.write(map_data)
+    destination.write(index_data)
+    destination.write(
+        TRAILER.pack(
+            offset,
+            len(map_data),
+            offset + len(map_data),
+            len(index_data),
+            image_size,
+            unique_pages,
+            image_digest.digest(),
+            MAGIC
+        )
+    )
+    return {
+        'image_size': image_size,
+        'pages': len(page_map),
+        'zero_pages': zero_pages,
+        'unique_pages': unique_pages,
+        'packed_size': offset + len(map_data) + len(index_data) + TRAILER.size,
+        'sha256': image_digest.hexdigest()
+    }
+
+
+class SparseImageReader(io.RawIOBase):
+    """Presents a sparse image as the original flat image without expanding it.
+
+    source is any seekable binary file object, such as an open file or a remote.S3RangeReader.
+    Decompressed chunks are kept in an LRU cache of cached_chunks entries.
+    """
+
+    def __init__(self, source, cached_chunks=64):
+        super(SparseImageReader, self).__init__()
+        self.source = source
+        self.cached_chunks = cached_chunks
+        self.position = 0
+        self._chunks = OrderedDict()
+
+        self.source.seek(0)
+        magic, version, self.page_size, self.pages_per_chunk = HEADER.unpack(
+            _read_exactly(self.source, HEADER.size)
+        )
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a version {} sparse image.'.format(VERSION))
+
+        self.source.seek(-TRAILER.size, io.SEEK_END)
+        (map_offset, map_length, index_offset, index_length, self.size,
+         self.unique_pages, self.sha256, magic) = TRAILER.unpack(_read_exactly(self.source, TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError('Truncated sparse image.')
+
+        self.source.seek(map_offset)
+        self.page_map = _from_bytes(_uint32_array(), zlib.decompress(_read_exactly(self.source, map_length)))
+        self.source.seek(index_offset)
+        self.chunk_offsets = _from_bytes(_uint64_array(), zlib.decompress(_read_exactly(self.source, index_length)))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('Invalid whence: {}'.format(whence))
+        if position < 0:
+            raise ValueError('Negative seek position: {}'.format(position))
+        self.position = position
+        return self.position
+
+    def readinto(self, buffer):
+        data = self.read_at(self.position, len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(0, self.size - self.position)
+        data = self.read_at(self.position, size)
+        self.position += len(data)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def read_at(self, offset, size):
+        """Return up to size bytes of the original image starting at offset."""
+        if offset >= self.size or size <= 0:
+            return b''
+        end = min(offset + size, self.size)
+        pieces = []
+        page_index = offset // self.page_size
+        while offset < end:
+            page_start = page_index * self.page_size
+            take_from = offset - page_start
+            take_to = min(end - page_start, self.page_size)
+            page = self._page(self.page_map[page_index])
+            if page is None:
+                pieces.append(b'\x00' * (take_to - take_from))
+            else:
+                pieces.append(page[take_from:take_to])
+            offset = page_start + take_to
+            page_index += 1
+        return b''.join(pieces)
+
+    def _page(self, entry):
+        if entry == 0:
+            return None
+        unique_page = entry - 1
+        chunk_index = unique_page // self.pages_per_chunk
+        start = (unique_page % self.pages_per_chunk) * self.page_size
+        return self._chunk(chunk_index)[start:start + self.page_size]
+
+    def _chunk(self, chunk_index):
+        chunk = self._chunks.get(chunk_index)
+        if chunk is not None:
+            self._chunks.move_to_end(chunk_index)
+            return chunk
+        start = self.chunk_offsets[chunk_index]
+        self.source.seek(start)
+        chunk = zlib.decompress(_read_exactly(self.source, self.chunk_offsets[chunk_index + 1] - start))
+        self._chunks[chunk_index] = chunk
+        while len(self._chunks) > self.cached_chunks:
+            self._chunks.popitem(last=False)
+        return chunk
+
+
+def main(argv):
+    if len(argv) != 4 or argv[1] != 'pack':
+        print('Usage: {} pack <source image or -> <destination>'.format(argv[0]), file=sys.stderr)
+        return 2
+    if argv[2] == '-':
+        source = getattr(sys.stdin, 'buffer', sys.stdin)
+    else:
+        source = open(argv[2], 'rb')
+    with open(argv[3], 'wb') as destination:
+        stats = pack(source, destination)
+    source.close()
+    print(
+        'Packed {image_size} bytes into {packed_size}: {pages} pages, {zero_pages} zero, '
+        '{unique_pages} unique. sha256 {sha256}'.format(**stats)
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
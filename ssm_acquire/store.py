@@ -0,0 +1,342 @@
+"""Indexed local store of rekall and osquery results for cross-instance queries."""
+import calendar
+import json
+import os
+import re
+import sqlite3
+
+from logging import getLogger
+from ssm_acquire import common
+
+
+config = common.get_config()
+logger = getLogger(__name__)
+
+OUTPUT_SUFFIX = '-output.json'
+INTERROGATION_LOG = 'interrogation.log'
+CAPTURE_NAMES = ('capture.aff4', 'capture.sparse')
+ELEMENT_DELIMITERS = ' \t\r\n,]'
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS sources (
+        source_id INTEGER PRIMARY KEY,
+        path TEXT UNIQUE NOT NULL,
+        instance_id TEXT NOT NULL,
+        plugin TEXT NOT NULL,
+        capture_time REAL NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL
+    )""",
+    # AUTOINCREMENT so rows of a re-ingested source never reuse the ids of the rows they replace.
+    """CREATE TABLE IF NOT EXISTS results (
+        row_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source_id INTEGER NOT NULL,
+        instance_id TEXT NOT NULL,
+        plugin TEXT NOT NULL,
+        capture_time REAL NOT NULL,
+        data TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS fields (
+        row_id INTEGER NOT NULL,
+        instance_id TEXT NOT NULL,
+        plugin TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT
+    )""",
+    'CREATE INDEX IF NOT EXISTS results_instance ON results (instance_id, plugin, capture_time)',
+    'CREATE INDEX IF NOT EXISTS results_source ON results (source_id)',
+    'CREATE INDEX IF NOT EXISTS fields_lookup ON fields (key, value, plugin)',
+    'CREATE INDEX IF NOT EXISTS fields_row ON fields (row_id)',
+]
+
+
+def default_db_path():
+    return os.path.expanduser(
+        config('results_db', namespace='ssm_acquire', default='~/.ssm_acquire/results.db')
+    )
+
+
+def is_result_file(file_name):
+    return file_name.endswith(OUTPUT_SUFFIX) or file_name == INTERROGATION_LOG
+
+
+def iter_json_array(fh, chunk_size=65536):
+    """Yield the elements of a top level json array without loading the whole document."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    eof = False
+    while True:
+        buffer = buffer.lstrip()
+        if not started:
+            if buffer.startswith('['):
+                buffer = buffer[1:]
+                started = True
+                continue
+            elif buffer:
+                raise ValueError('Expected a json array.')
+        elif buffer.startswith(','):
+            buffer = buffer[1:]
+            continue
+        elif buffer.startswith(']'):
+            return
+        elif buffer:
+            try:
+                element, end = decoder.raw_decode(buffer)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                # A number may continue in the next chunk until it is followed by a delimiter.
+                if eof or (end < len(buffer) and buffer[end] in ELEMENT_DELIMITERS):
+                    yield element
+                    buffer = buffer[end:]
+                    continue
+
+        if eof:
+            if started:
+                raise ValueError('Unterminated json array.')
+            return
+        chunk = fh.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer += chunk
+
+
+def iter_rekall_rows(fh):
+    """Yield the row dicts of a rekall --format=json output document."""
+    for message in iter_json_array(fh):
+        if isinstance(message, list) and len(message) == 2 and message[0] == 'r':
+            yield message[1]
+
+
+def iter_interrogation_rows(fh):
+    """Yield (query, row) for every osquery result in an interrogation log.
+
+    The log interleaves echo'd descriptions with the --json output of osqueryi.
+    """
+    query = None
+    pending = []
+    for line in fh:
+        stripped = line.strip()
+        if pending:
+            pending.append(line)
+            if stripped.endswith(']'):
+                try:
+                    rows = json.loads(''.join(pending))
+                except ValueError:
+                    continue
+                pending = []
+                for row in rows:
+                    yield query, row
+        elif stripped.startswith('['):
+            pending = [line]
+            if stripped.endswith(']'):
+                try:
+                    rows = json.loads(stripped)
+                except ValueError:
+                    continue
+                pending = []
+                for row in rows:
+                    yield query, row
+        elif stripped and not stripped.startswith('-'):
+            query = stripped
+    if pending:
+        logger.warning('Truncated osquery result in interrogation log for query: {}'.format(query))
+
+
+def _slug(text):
+    return re.sub(r'[^a-z0-9]+', '-', (text or 'unknown').lower()).strip('-')
+
+
+def flatten(value, prefix=''):
+    """Flatten nested rekall objects into dotted key/value pairs."""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            for pair in flatten(item, '{}.{}'.format(prefix, key) if prefix else key):
+                yield pair
+    elif isinstance(value, list):
+        for item in value:
+            for pair in flatten(item, prefix):
+                yield pair
+    elif value is None:
+        yield prefix, None
+    else:
+        yield prefix, str(value)
+
+
+class ResultStore(object):
+    def __init__(self, db_path=None):
+        self.db_path = db_path or default_db_path()
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self.connection = sqlite3.connect(self.db_path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def _source_is_current(self, path, capture_time, size, mtime):
+        row = self.connection.execute(
+            'SELECT capture_time, size, mtime FROM sources WHERE path = ?', (path,)
+        ).fetchone()
+        return row is not None and tuple(row) == (capture_time, size, mtime)
+
+    def _replace_source(self, path, instance_id, plugin, capture_time, size, mtime):
+        cursor = self.connection.cursor()
+        existing = cursor.execute('SELECT source_id FROM sources WHERE path = ?', (path,)).fetchone()
+        if existing is not None:
+            cursor.execute(
+                'DELETE FROM fields WHERE row_id IN (SELECT row_id FROM results WHERE source_id = ?)', existing
+            )
+            cursor.execute('DELETE FROM results WHERE source_id = ?', existing)
+            cursor.execute('DELETE FROM sources WHERE source_id = ?', existing)
+        cursor.execute(
+            'INSERT INTO sources (path, instance_id, plugin, capture_time, size, mtime) VALUES (?, ?, ?, ?, ?, ?)',
+            (path, instance_id, plugin, capture_time, size, mtime)
+        )
+        return cursor.lastrowid
+
+    def _insert_rows(self, source_id, instance_id, capture_time, rows):
+        cursor = self.connection.cursor()
+        count = 0
+        for plugin, row in rows:
+            cursor.execute(
+                'INSERT INTO results (source_id, instance_id, plugin, capture_time, data) VALUES (?, ?, ?, ?, ?)',
+                (source_id, instance_id, plugin, capture_time, json.dumps(row, sort_keys=True))
+            )
+            row_id = cursor.lastrowid
+            cursor.executemany(
+                'INSERT INTO fields (row_id, instance_id, plugin, key, value) VALUES (?, ?, ?, ?, ?)',
+                [(row_id, instance_id, plugin, key, value) for key, value in flatten(row)]
+            )
+            count += 1
+        return count
+
+    def ingest_file(self, path, instance_id, capture_time=None):
+        """Ingest one rekall output or interrogation log.  Returns the number of rows added.
+
+        capture_time is seconds since the epoch and defaults to the modification time of path.
+        """
+        path = os.path.abspath(path)
+        file_name = os.path.basename(path)
+        stat = os.stat(path)
+        if capture_time is None:
+            capture_time = stat.st_mtime
+        if self._source_is_current(path, capture_time, stat.st_size, stat.st_mtime):
+            logger.debug('Skipping already ingested result: {}'.format(path))
+            return 0
+
+        if file_name == INTERROGATION_LOG:
+            plugin = 'osquery'
+        else:
+            plugin = file_name[:-len(OUTPUT_SUFFIX)].replace('-{}'.format(instance_id), '')
+
+        with self.connection:
+            source_id = self._replace_source(path, instance_id, plugin, capture_time, stat.st_size, stat.st_mtime)
+            with open(path) as fh:
+                if plugin == 'osquery':
+                    rows = (
+                        ('osquery:{}'.format(_slug(query)), row) for query, row in iter_interrogation_rows(fh)
+                    )
+                else:
+                    rows = ((plugin, row) for row in iter_rekall_rows(fh))
+                count = self._insert_rows(source_id, instance_id, capture_time, rows)
+        logger.info('Ingested {} rows for plugin: {} on instance: {}'.format(count, plugin, instance_id))
+        return count
+
+    def ingest_directory(self, directory, instance_id, capture_times=None):
+        """Ingest every result file in directory.  capture_times maps file names to their capture time."""
+        capture_times = capture_times or {}
+        count = 0
+        for file_name in sorted(os.listdir(directory)):
+            if is_result_file(file_name):
+                try:
+                    count += self.ingest_file(
+                        os.path.join(directory, file_name), instance_id, capture_times.get(file_name)
+                    )
+                except ValueError as e:
+                    logger.error('Could not parse result file: {} due to: {}'.format(file_name, e))
+        return count
+
+    def find_instances(self, criteria, plugin=None):
+        """Return the instance ids having a single result row that matches every key/value in criteria.
+
+        Keys are the flattened column names, e.g. {'name': 'sshd', 'port': '22'}.
+        A plugin ending in ':' matches every osquery query, e.g. 'osquery:'.
+        """
+        if not criteria:
+            raise ValueError('At least one criterion is required.')
+        joins = []
+        where = []
+        params = []
+        for index, (key, value) in enumerate(sorted(criteria.items())):
+            alias = 'f{}'.format(index)
+            if index == 0:
+                joins.append('fields AS {}'.format(alias))
+            else:
+                joins.append('JOIN fields AS {} ON {}.row_id = f0.row_id'.format(alias, alias))
+            where.append('{0}.key = ? AND {0}.value = ?'.format(alias))
+            params.extend([key, str(value)])
+            if plugin is not None:
+                if plugin.endswith(':'):
+                    where.append('{}.plugin >= ? AND {}.plugin < ?'.format(alias, alias))
+                    params.extend([plugin, plugin[:-1] + ';'])
+                else:
+                    where.append('{}.plugin = ?'.format(alias))
+                    params.append(plugin)
+        query = 'SELECT DISTINCT f0.instance_id FROM {} WHERE {} ORDER BY f0.instance_id'.format(
+            ' '.join(joins), ' AND '.join(where)
+        )
+        return [row[0] for row in self.connection.execute(query, params)]
+
+    def find_listening(self, process_name, port):
+        """Instances where osquery saw process_name listening on port."""
+        return self.find_instances({'name': process_name, 'port': port}, plugin='osquery:')
+
+    def rows(self, instance_id, plugin=None):
+        query = 'SELECT plugin, capture_time, data FROM results WHERE instance_id = ?'
+        params = [instance_id]
+        if plugin is not None:
+            query += ' AND plugin = ?'
+            params.append(plugin)
+        for plugin, capture_time, data in self.connection.execute(query + ' ORDER BY row_id', params):
+            yield plugin, capture_time, json.loads(data)
+
+
+def _epoch(last_modified):
+    return calendar.timegm(last_modified.utctimetuple())
+
+
+def fetch_results(s3_manager, instance_id):
+    """Download result objects for instance_id that are not already on disk.
+
+    Returns the local directory and a mapping of result file names to their capture time.  That
+    is when the capture was uploaded to the asset store or, without a capture, when the result was.
+    """
+    s3_manager.create_instance_directory(instance_id)
+    keys = s3_manager.list_objects_for_key(instance_id) or []
+    capture_time = None
+    for key in keys:
+        if key['Key'].split('/')[-1] in CAPTURE_NAMES:
+            capture_time = max(capture_time or 0, _epoch(key['LastModified']))
+
+    missing = []
+    capture_times = {}
+    for key in keys:
+        file_name = key['Key'].split('/')[-1]
+        local_path = '/tmp/{}'.format(key['Key'])
+        if not is_result_file(file_name):
+            continue
+        capture_times[file_name] = capture_time if capture_time is not None else _epoch(key['LastModified'])
+        if os.path.isfile(local_path) and os.path.getsize(local_path) == key['Size']:
+            continue
+        missing.append(key)
+    if missing:
+        s3_manager.get_files(missing)
+    return '/tmp/{}'.format(instance_id), capture_times
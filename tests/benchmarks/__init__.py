@@ -0,0 +1,285 @@
+"""End to end benchmarks of ssm_acquire against moto and a stub docker client.
+
+Each scenario runs in a fresh interpreter so peak RSS and module level configuration are
+isolated.  moto serves S3 from the same interpreter, so peak RSS includes the objects it holds
+in memory, about 3.5 times the capture size for the capture-* scenarios.  Peak RSS is therefore
+only compared for scenarios that do not upload a capture.  Run them with::
+
+    python -m tests.benchmarks smoke fleet-50 --baseline tests/benchmarks/baseline.json
+"""
+import json
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import tempfile
+import time
+
+from collections import OrderedDict
+from collections import namedtuple
+
+
+MIB = 1024 * 1024
+GIB = 1024 * MIB
+
+FIXTURE_PROFILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fixtures', '4.14.72-73.55.amzn2.x86_64.zip'
+)
+
+Scenario = namedtuple(
+    'Scenario',
+    ['instances', 'capture_bytes', 'phases', 'container_seconds', 'pending_polls', 'result_rows']
+)
+
+SCENARIOS = OrderedDict([
+    ('smoke', Scenario(1, 16 * MIB, ('acquire', 'build', 'interrogate', 'analyze'), 0.05, 2, 100)),
+    ('fleet-1', Scenario(1, MIB, ('acquire', 'build', 'interrogate'), 0.0, 4, 100)),
+    ('fleet-50', Scenario(50, MIB, ('acquire', 'build', 'interrogate'), 0.0, 4, 100)),
+    ('fleet-500', Scenario(500, MIB, ('acquire', 'build', 'interrogate'), 0.0, 4, 100)),
+    ('capture-1g', Scenario(1, GIB, ('analyze',), 0.5, 0, 10000)),
+    ('capture-8g', Scenario(1, 8 * GIB, ('analyze',), 2.0, 0, 10000)),
+])
+
+# Metrics where a higher number is a regression.
+COMPARED_METRICS = ['wall_seconds', 'api_calls', 'peak_rss_kb', 'bytes_copied']
+# Metrics that mostly measure moto when it holds a capture in memory.
+CAPTURE_METRICS = ['peak_rss_kb']
+
+# time.sleep is patched out while the cli runs; stub containers still take real time.
+_sleep = time.sleep
+
+
+class ZeroStream(object):
+    """A readable stream of size zero bytes that never holds more than one read in memory."""
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        self.remaining -= size
+        return b'\x00' * size
+
+
+class StubContainer(object):
+    def __init__(self, command, volumes, duration, result_rows):
+        self.command = command
+        self.volumes = volumes
+        self.duration = duration
+        self.result_rows = result_rows
+        self.attrs = {}
+        self.started = time.time()
+
+    def _host_path(self, container_path):
+        for host_path, bind in self.volumes.items():
+            if container_path.startswith(bind['bind'] + '/'):
+                return os.path.join(host_path, container_path[len(bind['bind']) + 1:])
+
+    def wait(self, timeout=None):
+        _sleep(max(0.0, self.started + self.duration - time.time()))
+        output = re.search(r'--output=(\S+)', self.command)
+        if output:
+            rows = [['m', {'plugin_name': 'benchmark'}]]
+            rows.extend(['r', {'proc': {'name': 'process-{}'.format(i), 'pid': i}}] for i in range(self.result_rows))
+            with open(self._host_path(output.group(1)), 'w') as fh:
+                json.dump(rows, fh)
+        elif 'convert_profile' in self.command:
+            profile_json = self.command.split()[-1]
+            with open(self._host_path('/files/' + profile_json), 'w') as fh:
+                fh.write('{}')
+        return {'StatusCode': 0}
+
+    def reload(self):
+        finished = time.time()
+        self.attrs = {
+            'State': {
+                'StartedAt': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(self.started)) + '.000000000Z',
+                'FinishedAt': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(finished)) + '.000000000Z',
+            }
+        }
+
+    def logs(self):
+        return b''
+
+    def stop(self):
+        pass
+
+    def remove(self):
+        pass
+
+
+class StubImage(object):
+    id = 'sha256:benchmark'
+
+
+class StubDockerClient(object):
+    """Stands in for docker.from_env() with containers that take a simulated duration."""
+
+    def __init__(self, container_seconds, result_rows):
+        self.container_seconds = container_seconds
+        self.result_rows = result_rows
+        self.containers = self
+        self.images = self
+        self.runs = 0
+
+    def run(self, image, command, detach, volumes):
+        self.runs += 1
+        return StubContainer(command, volumes, self.container_seconds, self.result_rows)
+
+    def get(self, name):
+        return StubImage()
+
+    def pull(self, name):
+        return StubImage()
+
+
+def _configure_environment(work_dir):
+    ini_path = os.path.join(work_dir, 'threatresponse.ini')
+    with open(ini_path, 'w') as fh:
+        fh.write('[ssm_acquire]\n')
+        fh.write('asset_bucket=ssm-acquire-benchmark\n')
+        fh.write('yara_file_dir={}\n'.format(os.path.join(work_dir, 'yara')))
+        fh.write('results_db={}\n'.format(os.path.join(work_dir, 'results.db')))
+    os.environ.update({
+        'THREATRESPONSE_INI': ini_path,
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'AWS_DEFAULT_REGION': 'us-west-2',
+    })
+
+
+def _run_scenario(name, scenario, queue):
+    """Child process entry point.  Puts a dict of results on queue."""
+    from unittest import mock
+
+    import boto3
+    from click.testing import CliRunner
+    from moto import mock_aws
+
+    work_dir = tempfile.mkdtemp(prefix='ssm-acquire-benchmark-')
+    _configure_environment(work_dir)
+
+    from ssm_acquire import cli
+    from ssm_acquire import common
+    from ssm_acquire import metrics
+
+    simulated_wait = [0.0]
+    polls = {}
+    poll = common.CommandMonitor.poll
+
+    def fake_sleep(seconds):
+        simulated_wait[0] += seconds
+
+    def pending_poll(monitor):
+        command_id = monitor.command_id
+        polls[command_id] = polls.get(command_id, 0) + 1
+        status = poll(monitor)
+        if polls[command_id] <= scenario.pending_polls:
+            return None
+        return status
+
+    instance_dirs = []
+    try:
+        with mock_aws():
+            s3 = boto3.client('s3')
+            s3.create_bucket(
+                Bucket='ssm-acquire-benchmark', CreateBucketConfiguration={'LocationConstraint': 'us-west-2'}
+            )
+            ec2 = boto3.client('ec2')
+            reservation = ec2.run_instances(ImageId='ami-12c6146b', MinCount=scenario.instances, MaxCount=scenario.instances)
+            instance_ids = [instance['InstanceId'] for instance in reservation['Instances']]
+            for instance_id in instance_ids:
+                instance_dirs.append('/tmp/{}'.format(instance_id))
+                shutil.rmtree(instance_dirs[-1], ignore_errors=True)
+                if 'analyze' in scenario.phases:
+                    s3.upload_fileobj(
+                        ZeroStream(scenario.capture_bytes), 'ssm-acquire-benchmark', '{}/capture.aff4'.format(instance_id)
+                    )
+                    s3.upload_file(
+                        FIXTURE_PROFILE, 'ssm-acquire-benchmark', '{}/{}'.format(instance_id, os.path.basename(FIXTURE_PROFILE))
+                    )
+
+            docker_client = StubDockerClient(scenario.container_seconds, scenario.result_rows)
+            arguments = ['--{}'.format(phase) for phase in scenario.phases]
+            metrics.recorder.reset()
+            runner = CliRunner()
+
+            with mock.patch('docker.from_env', return_value=docker_client), \
+                    mock.patch('time.sleep', side_effect=fake_sleep), \
+                    mock.patch.object(common.CommandMonitor, 'poll', pending_poll):
+                started = time.monotonic()
+                for instance_id in instance_ids:
+                    result = runner.invoke(cli.main, ['--instance_id', instance_id] + arguments)
+                    if result.exit_code != 0:
+                        raise RuntimeError('ssm_acquire failed for {}: {!r}'.format(instance_id, result.exception))
+                wall_seconds = time.monotonic() - started
+
+        trace = metrics.recorder.to_dict()
+        counters = trace['counters']
+
+        def total(counter_name):
+            return sum(counter['value'] for counter in counters if counter['name'] == counter_name)
+
+        queue.put({
+            'scenario': name,
+            'instances': scenario.instances,
+            'capture_bytes': scenario.capture_bytes,
+            'wall_seconds': wall_seconds,
+            'simulated_wait_seconds': simulated_wait[0],
+            'api_calls': total('api_calls_total'),
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'bytes_copied': (
+                total('s3_bytes_downloaded_total') + total('s3_bytes_uploaded_total') + total('capture_bytes_fetched_total')
+            ),
+            'containers': docker_client.runs,
+        })
+    except Exception as e:
+        queue.put({'scenario': name, 'error': repr(e)})
+    finally:
+        for instance_dir in instance_dirs:
+            shutil.rmtree(instance_dir, ignore_errors=True)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run(name):
+    """Run one scenario in a fresh interpreter and return its results."""
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_scenario, args=(name, SCENARIOS[name], queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if 'error' in result:
+        raise RuntimeError('Benchmark {} failed: {}'.format(name, result['error']))
+    return result
+
+
+def compared_metrics(scenario):
+    """The metrics of COMPARED_METRICS that measure ssm_acquire rather than moto for scenario."""
+    if 'analyze' in scenario.phases:
+        return [metric for metric in COMPARED_METRICS if metric not in CAPTURE_METRICS]
+    return COMPARED_METRICS
+
+
+def compare(results, baseline, tolerance=0.1, wall_slack=0.25):
+    """Return a list of regressions of results against a baseline mapping of scenario to results."""
+    regressions = []
+    for result in results:
+        expected = baseline.get(result['scenario'])
+        if expected is None:
+            continue
+        for metric in compared_metrics(SCENARIOS[result['scenario']]):
+            if metric not in expected:
+                continue
+            limit = expected[metric] * (1 + tolerance)
+            if metric == 'wall_seconds':
+                limit += wall_slack
+            if result[metric] > limit:
+                regressions.append(
+                    '{}: {} {} exceeds baseline {} (limit {:.2f})'.format(
+                        result['scenario'], metric, result[metric], expected[metric], limit
+                    )
+                )
+    return regressions
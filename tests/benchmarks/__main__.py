@@ -0,0 +1,50 @@
+"""Command line entry point for the ssm_acquire benchmarks."""
+import json
+import sys
+
+import click
+
+from tests import benchmarks
+
+
+@click.command()
+@click.argument('scenarios', nargs=-1)
+@click.option('--baseline', default=None, help='Json file of stored results to compare against.')
+@click.option('--save-baseline', default=None, help='Write the results of this run to a json baseline file.')
+@click.option('--tolerance', default=0.1, help='Fraction a metric may exceed the baseline by before failing.')
+@click.option('--list', 'list_scenarios', is_flag=True, help='List the available scenarios.')
+def main(scenarios, baseline, save_baseline, tolerance, list_scenarios):
+    """Benchmark ssm_acquire end to end against moto and a stub docker client."""
+    if list_scenarios:
+        for name, scenario in benchmarks.SCENARIOS.items():
+            click.echo('{:<12} {}'.format(name, scenario))
+        return 0
+
+    results = []
+    for name in scenarios or ['smoke']:
+        if name not in benchmarks.SCENARIOS:
+            raise click.BadParameter('Unknown scenario: {}'.format(name))
+        result = benchmarks.run(name)
+        results.append(result)
+        click.echo(
+            '{scenario:<12} wall={wall_seconds:.2f}s simulated_wait={simulated_wait_seconds:.1f}s '
+            'api_calls={api_calls} peak_rss={peak_rss_kb}KiB (including moto) bytes_copied={bytes_copied} '
+            'containers={containers}'.format(**result)
+        )
+
+    if save_baseline is not None:
+        with open(save_baseline, 'w') as fh:
+            json.dump({result['scenario']: result for result in results}, fh, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        with open(baseline) as fh:
+            regressions = benchmarks.compare(results, json.load(fh), tolerance)
+        for regression in regressions:
+            click.echo('REGRESSION {}'.format(regression), err=True)
+        if regressions:
+            sys.exit(1)
+    return 0
+
+
+if __name__ == '__main__':
+    main()
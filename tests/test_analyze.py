@@ -0,0 +1,263 @@
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import types
+
+from collections import namedtuple
+from unittest import mock
+
+import boto3
+import pytest
+
+from moto import mock_aws
+
+from ssm_acquire import analyze
+from ssm_acquire import remote
+from ssm_acquire import sparse
+from tests.benchmarks import StubContainer
+from tests.benchmarks import StubDockerClient
+from tests.test_remote import StubS3Client
+
+
+BUCKET = 'ssm-acquire-test'
+CREDENTIALS = {'Credentials': {'AccessKeyId': 'testing', 'SecretAccessKey': 'testing', 'SessionToken': 'testing'}}
+
+Match = namedtuple('Match', ['rule', 'strings'])
+StringMatch = namedtuple('StringMatch', ['identifier', 'instances'])
+Instance = namedtuple('Instance', ['offset', 'matched_length'])
+
+
+class StubRules(object):
+    """Matches the contents of a rule file as a literal string, like yara-python 4.3 reports it."""
+
+    def __init__(self, needle):
+        self.needle = needle
+        self.scanned = []
+
+    def match(self, data):
+        self.scanned.append(len(data))
+        instances = []
+        offset = data.find(self.needle)
+        while offset != -1:
+            instances.append(Instance(offset, len(self.needle)))
+            offset = data.find(self.needle, offset + 1)
+        if not instances:
+            return []
+        return [Match('literal', [StringMatch('$needle', instances)])]
+
+
+class FailingContainer(StubContainer):
+    """Writes partial output and exits non-zero, like a rekall plugin that crashed."""
+
+    def wait(self, timeout=None):
+        super(FailingContainer, self).wait(timeout)
+        return {'StatusCode': 1}
+
+
+class RecordingDockerClient(StubDockerClient):
+    """Runs containers instantly, failing the ones whose command mentions a failing plugin."""
+
+    def __init__(self, failing=()):
+        super(RecordingDockerClient, self).__init__(0, 1)
+        self.failing = failing
+        self.commands = []
+
+    def run(self, image, command, detach, volumes):
+        self.commands.append(command)
+        if any(' {} '.format(plugin) in command for plugin in self.failing):
+            return FailingContainer(command, volumes, 0, 1)
+        return super(RecordingDockerClient, self).run(image, command, detach, volumes)
+
+
+@pytest.fixture
+def stub_yara(monkeypatch):
+    compiled = []
+
+    def compile(filepath):
+        with open(filepath, 'rb') as fh:
+            compiled.append(StubRules(fh.read().strip()))
+        return compiled[-1]
+
+    monkeypatch.setitem(sys.modules, 'yara', types.ModuleType('yara'))
+    monkeypatch.setattr(sys.modules['yara'], 'compile', compile, raising=False)
+    return compiled
+
+
+@pytest.fixture
+def environment(monkeypatch, tmp_path):
+    yara_file_dir = tmp_path / 'yara'
+    yara_file_dir.mkdir()
+    monkeypatch.setenv('SSM_ACQUIRE_ASSET_BUCKET', BUCKET)
+    monkeypatch.setenv('SSM_ACQUIRE_YARA_FILE_DIR', str(yara_file_dir))
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    return yara_file_dir
+
+
+@pytest.fixture
+def instance_id():
+    instance_id = 'i-ssm-acquire-test-analyze'
+    shutil.rmtree('/tmp/{}'.format(instance_id), ignore_errors=True)
+    yield instance_id
+    shutil.rmtree('/tmp/{}'.format(instance_id), ignore_errors=True)
+
+
+def test_yara_scan_reports_image_offsets_once(environment, stub_yara, tmp_path):
+    image = bytearray(100)
+    # Inside the first window, across the window edge, inside the overlap only and in the last window.
+    for offset in (10, 30, 35, 96):
+        image[offset:offset + 4] = b'EVIL'
+    client = StubS3Client(bytes(image))
+    native = analyze.NativeRekall('i-1/capture.aff4', CREDENTIALS)
+    native.capture = remote.S3RangeReader(client, BUCKET, native.object_key, block_size=16, cache_bytes=64)
+    rule_file = tmp_path / 'evil.yar'
+    rule_file.write_bytes(b'EVIL')
+
+    matches = native.yara_scan(str(rule_file), window_size=32, overlap=8)
+
+    assert [match['offset'] for match in matches] == [10, 30, 35, 96]
+    assert matches[0] == {'offset': 10, 'rule': 'literal', 'identifier': '$needle', 'length': 4}
+    assert stub_yara[0].scanned == [40, 40, 36, 4]
+    json.dumps(matches)
+
+
+def test_capture_digest(environment):
+    client = StubS3Client(b'\x00' * 10)
+    native = analyze.NativeRekall('i-1/capture.aff4', CREDENTIALS)
+    native.capture = remote.S3RangeReader(client, BUCKET, native.object_key, size=10)
+    native.capture.etag = '"abc"'
+    assert native.capture_digest() == 'etag:"abc"'
+
+
+def test_native_yara_scan_runs_before_the_capture_is_downloaded(environment, stub_yara, instance_id):
+    (environment / 'evil.yar').write_bytes(b'EVIL')
+    with mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET)
+        s3.put_object(Bucket=BUCKET, Key='{}/capture.aff4'.format(instance_id), Body=b'\x00' * 1000 + b'EVIL')
+
+        with mock.patch('docker.from_env'):
+            manager = analyze.RekallManager(instance_id, CREDENTIALS)
+        assert manager.run_native_yara_scan() is True
+
+        output_name = 'yara-scan-evil.yar-{}-output.json'.format(instance_id)
+        assert not os.path.exists('/tmp/{}/capture.aff4'.format(instance_id))
+        with open('/tmp/{}/{}'.format(instance_id, output_name)) as fh:
+            assert json.load(fh)[1] == ['r', {'offset': 1000, 'rule': 'literal', 'identifier': '$needle', 'length': 4}]
+        uploaded = s3.head_object(Bucket=BUCKET, Key='{}/{}'.format(instance_id, output_name))
+        assert uploaded['Metadata']['ssm-acquire-cache-key']
+
+        # Unchanged rules and capture are not scanned again.
+        assert manager.run_native_yara_scan() is True
+        assert len(stub_yara) == 1
+
+
+def put_sparse_capture(s3, instance_id, image):
+    packed = io.BytesIO()
+    sparse.pack(io.BytesIO(image), packed)
+    s3.put_object(Bucket=BUCKET, Key='{}/capture.sparse'.format(instance_id), Body=packed.getvalue())
+
+
+def test_sparse_captures_are_scanned_in_place_and_not_downloaded(environment, stub_yara, instance_id, caplog):
+    (environment / 'evil.yar').write_bytes(b'EVIL')
+    image = bytearray(3 * sparse.PAGE_SIZE)
+    image[sparse.PAGE_SIZE + 100:sparse.PAGE_SIZE + 104] = b'EVIL'
+    with mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET)
+        put_sparse_capture(s3, instance_id, bytes(image))
+        s3.put_object(Bucket=BUCKET, Key='{}/profile.zip'.format(instance_id), Body=b'profile')
+
+        with mock.patch('docker.from_env'):
+            manager = analyze.RekallManager(instance_id, CREDENTIALS)
+        assert manager.run_native_yara_scan() is True
+        assert sorted(manager.download_incident_data()) == [
+            'analysis-manifest.json', 'profile.zip', 'yara-scan-evil.yar-{}-output.json'.format(instance_id)
+        ]
+        with open('/tmp/{}/yara-scan-evil.yar-{}-output.json'.format(instance_id, instance_id)) as fh:
+            assert json.load(fh)[1][1]['offset'] == sparse.PAGE_SIZE + 100
+
+        assert manager.run_rekall_plugins(yara=False) == []
+        assert any('Only a sparse capture exists' in message for message in caplog.messages)
+
+
+def test_command_output_is_not_downloaded(environment, instance_id):
+    with mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET)
+        s3.put_object(Bucket=BUCKET, Key='{}/profile.zip'.format(instance_id), Body=b'profile')
+        s3.put_object(
+            Bucket=BUCKET, Key='{0}/ssm-output/c-1/{0}/awsrunShellScript/0.awsrunShellScript/stdout'.format(instance_id),
+            Body=b'done'
+        )
+
+        with mock.patch('docker.from_env'):
+            manager = analyze.RekallManager(instance_id, CREDENTIALS)
+        assert manager.download_incident_data() == ['profile.zip']
+
+
+def test_native_yara_scan_needs_yara_python(environment, instance_id, monkeypatch, caplog):
+    (environment / 'evil.yar').write_bytes(b'EVIL')
+    monkeypatch.setitem(sys.modules, 'yara', None)
+    with mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET)
+        put_sparse_capture(s3, instance_id, b'EVIL')
+
+        with mock.patch('docker.from_env'):
+            manager = analyze.RekallManager(instance_id, CREDENTIALS)
+        with caplog.at_level(logging.ERROR):
+            assert manager.run_native_yara_scan() is False
+    assert any('install ssm_acquire[native] to scan the sparse capture' in message for message in caplog.messages)
+
+
+@pytest.fixture
+def capture(environment, instance_id):
+    """A downloaded capture and rekall profile, with an asset bucket for the results."""
+    with mock_aws():
+        boto3.client('s3').create_bucket(Bucket=BUCKET)
+        os.makedirs('/tmp/{}'.format(instance_id))
+        for name in ('capture.aff4', 'profile.zip'):
+            with open('/tmp/{}/{}'.format(instance_id, name), 'wb') as fh:
+                fh.write(name.encode('utf-8'))
+        yield instance_id
+
+
+def rekall_manager(instance_id, docker_client):
+    with mock.patch('docker.from_env', return_value=docker_client):
+        return analyze.RekallManager(instance_id, CREDENTIALS)
+
+
+def test_failed_plugin_output_is_discarded(capture):
+    docker_client = RecordingDockerClient(failing=['netstat'])
+    manager = rekall_manager(capture, docker_client)
+    manager.rekall_plugins = ['psaux', 'netstat']
+    manager.run_rekall_plugins(yara=False)
+
+    output_name = 'netstat-{}-output.json'.format(capture)
+    assert not os.path.exists('/tmp/{}/{}'.format(capture, output_name))
+    listed = boto3.client('s3').list_objects_v2(Bucket=BUCKET, Prefix=capture)['Contents']
+    assert [key['Key'] for key in listed] == ['{}/psaux-{}-output.json'.format(capture, capture)]
+    with open('/tmp/{}/analysis-manifest.json'.format(capture)) as fh:
+        assert output_name not in json.load(fh)['results']
+
+    # The failed plugin runs again, the stored one does not.
+    manager.run_rekall_plugins(yara=False)
+    assert [command.split()[5] for command in docker_client.commands[3:]] == ['netstat']
+
+
+def test_a_new_rule_file_runs_only_that_file(environment, capture):
+    (environment / 'one.yar').write_text('rule one { condition: true }')
+    docker_client = RecordingDockerClient()
+    manager = rekall_manager(capture, docker_client)
+    manager.run_yara_scan()
+    assert len(docker_client.commands) == 1
+
+    (environment / 'two.yar').write_text('rule two { condition: true }')
+    manager.run_yara_scan()
+    assert len(docker_client.commands) == 2
+    assert '--yara_file /opt/yarascan/two.yar' in docker_client.commands[1]
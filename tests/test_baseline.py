@@ -0,0 +1,138 @@
+import json
+
+import pytest
+
+from ssm_acquire import baseline
+from ssm_acquire import store
+
+
+def write_psaux(directory, instance_id, processes):
+    path = directory / 'psaux-{}-output.json'.format(instance_id)
+    rows = [['r', {'proc': {'name': name, 'pid': pid}}] for pid, name in enumerate(processes)]
+    path.write_text(json.dumps(rows))
+    return str(path)
+
+
+def write_netstat(directory, instance_id, sockets):
+    path = directory / 'netstat-{}-output.json'.format(instance_id)
+    path.write_text(json.dumps([['r', socket] for socket in sockets]))
+    return str(path)
+
+
+def connection(laddr, lport, raddr, rport, state='ESTABLISHED', comm='sshd'):
+    return {'proto': 'TCP', 'laddr': laddr, 'lport': lport, 'raddr': raddr, 'rport': rport, 'state': state, 'comm': comm}
+
+
+@pytest.fixture
+def result_store(tmp_path):
+    result_store = store.ResultStore(str(tmp_path / 'results.db'))
+    yield result_store
+    result_store.close()
+
+
+def test_stable_fields_drop_volatile_columns():
+    row = {'proc': {'name': 'sshd', 'pid': 812, 'dtb': 1}, 'offset': '0xffff88003c6f0000', 'cmd': '0x1'}
+    assert baseline.stable_fields(row) == [('cmd', '0x1'), ('proc.name', 'sshd')]
+
+
+def test_stable_fields_reduce_addresses_and_ephemeral_ports():
+    assert baseline.stable_fields(connection('10.0.1.17', 51514, '52.94.0.10', 443)) == [
+        ('comm', 'sshd'), ('laddr', 'private-ipv4'), ('lport', 'ephemeral'), ('proto', 'TCP'),
+        ('raddr', 'public-ipv4'), ('rport', '443'), ('state', 'ESTABLISHED')
+    ]
+    # A listener keeps its port, and a connection to a high port keeps neither port.
+    assert ('lport', '4444') in baseline.stable_fields(connection('0.0.0.0', 4444, '0.0.0.0', 0, state='LISTEN'))
+    assert ('rport', 'ephemeral') in baseline.stable_fields(connection('10.0.1.17', 22, '10.0.9.4', 60022))
+    assert baseline.stable_fields({'address': '::', 'port': '22'}) == [('address', 'unspecified-ipv6'), ('port', '22')]
+    assert baseline.address_class('sshd') is None
+    assert baseline.address_class('127.0.0.1') == 'loopback-ipv4'
+
+
+def test_sockets_on_different_addresses_are_not_outliers(tmp_path, result_store):
+    result_store.ingest_file(write_netstat(tmp_path, 'i-1', [
+        connection('10.0.1.17', 51514, '52.94.0.10', 443),
+        connection('0.0.0.0', 22, '0.0.0.0', 0, state='LISTEN'),
+    ]), 'i-1')
+    result_store.ingest_file(write_netstat(tmp_path, 'i-2', [
+        connection('10.0.2.33', 40022, '52.94.0.99', 443),
+        connection('0.0.0.0', 22, '0.0.0.0', 0, state='LISTEN'),
+        connection('0.0.0.0', 4444, '0.0.0.0', 0, state='LISTEN', comm='nc'),
+    ]), 'i-2')
+
+    fleet = baseline.FleetBaseline(result_store)
+    fleet.build()
+    assert fleet.outliers('i-1', threshold=0.5) == []
+    assert [o['label'] for o in fleet.outliers('i-2', threshold=0.5)] == [
+        'comm=nc, laddr=unspecified-ipv4, lport=4444, proto=TCP, raddr=unspecified-ipv4, rport=0, state=LISTEN'
+    ]
+
+
+def test_fleet_can_be_limited_to_some_instances(tmp_path, result_store):
+    for instance_id, processes in [('i-1', ['init', 'java']), ('i-2', ['init', 'java']), ('i-3', ['init', 'nginx'])]:
+        result_store.ingest_file(write_psaux(tmp_path, instance_id, processes), instance_id)
+
+    fleet = baseline.FleetBaseline(result_store, instance_ids=['i-1', 'i-2', 'i-9'])
+    assert fleet.build() == 2
+    assert fleet.outliers('i-1', threshold=0.5) == []
+    assert fleet.outliers('i-3', threshold=0.5) == []
+
+
+class StubEc2Client(object):
+    """Pages describe_instances results like the ec2 paginator."""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.filters = None
+
+    def get_paginator(self, operation_name):
+        assert operation_name == 'describe_instances'
+        return self
+
+    def paginate(self, Filters):
+        self.filters = Filters
+        return iter(self.pages)
+
+
+def test_autoscaling_group_instances():
+    client = StubEc2Client([
+        {'Reservations': [{'Instances': [{'InstanceId': 'i-2'}, {'InstanceId': 'i-1'}]}]},
+        {'Reservations': [{'Instances': [{'InstanceId': 'i-3'}]}]},
+    ])
+    assert baseline.autoscaling_group_instances(client, 'web') == ['i-1', 'i-2', 'i-3']
+    assert client.filters == [{'Name': 'tag:aws:autoscaling:groupName', 'Values': ['web']}]
+
+
+def test_outliers(tmp_path, result_store):
+    for index in range(10):
+        instance_id = 'i-{}'.format(index)
+        processes = ['init', 'sshd'] + (['nc'] if index == 3 else [])
+        result_store.ingest_file(write_psaux(tmp_path, instance_id, processes), instance_id)
+
+    fleet = baseline.FleetBaseline(result_store)
+    assert fleet.build() == 10
+    outliers = fleet.outliers(threshold=0.1)
+    assert [(o['instance_id'], o['label'], o['instances'], o['fleet_size']) for o in outliers] == [
+        ('i-3', 'proc.name=nc', 1, 10)
+    ]
+    assert fleet.outliers('i-4', threshold=0.1) == []
+    assert list(fleet.frequencies('psaux'))[-1] == ('proc.name=nc', 1, 10)
+
+
+def test_reingested_rows_are_fingerprinted_again(tmp_path, result_store):
+    result_store.ingest_file(write_psaux(tmp_path, 'i-1', ['a', 'b']), 'i-1', capture_time=1000)
+    path = write_psaux(tmp_path, 'i-2', ['a', 'b'])
+    result_store.ingest_file(path, 'i-2', capture_time=1000)
+    fleet = baseline.FleetBaseline(result_store)
+    fleet.build()
+    assert fleet.outliers('i-2', threshold=0.5) == []
+
+    write_psaux(tmp_path, 'i-2', ['a', 'EVIL'])
+    result_store.ingest_file(path, 'i-2', capture_time=2000)
+    assert fleet.update_fingerprints() == 2
+    fleet.build()
+
+    assert [o['label'] for o in fleet.outliers('i-2', threshold=0.5)] == ['proc.name=EVIL']
+    stale = result_store.connection.execute(
+        'SELECT COUNT(*) FROM fingerprints WHERE row_id NOT IN (SELECT row_id FROM results)'
+    ).fetchone()[0]
+    assert stale == 0
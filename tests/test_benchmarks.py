@@ -0,0 +1,25 @@
+from tests import benchmarks
+
+
+def result(scenario, **metrics):
+    values = {'scenario': scenario, 'wall_seconds': 1.0, 'api_calls': 30, 'peak_rss_kb': 1000, 'bytes_copied': 100}
+    values.update(metrics)
+    return values
+
+
+def test_compare_reports_regressions():
+    baseline = {'fleet-1': result('fleet-1')}
+    assert benchmarks.compare([result('fleet-1', wall_seconds=1.3, api_calls=33)], baseline) == []
+    assert benchmarks.compare([result('fleet-1', api_calls=34, peak_rss_kb=2000)], baseline) == [
+        'fleet-1: api_calls 34 exceeds baseline 30 (limit 33.00)',
+        'fleet-1: peak_rss_kb 2000 exceeds baseline 1000 (limit 1100.00)',
+    ]
+    assert benchmarks.compare([result('fleet-50', api_calls=1000)], baseline) == []
+
+
+def test_compare_ignores_peak_rss_when_moto_holds_a_capture():
+    baseline = {'capture-1g': result('capture-1g'), 'smoke': result('smoke')}
+    assert benchmarks.compare([result('capture-1g', peak_rss_kb=5000), result('smoke', peak_rss_kb=5000)], baseline) == []
+    assert benchmarks.compare([result('capture-1g', bytes_copied=200)], baseline) == [
+        'capture-1g: bytes_copied 200 exceeds baseline 100 (limit 110.00)'
+    ]
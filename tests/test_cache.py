@@ -0,0 +1,99 @@
+import os
+import shutil
+
+import pytest
+
+from ssm_acquire import cache
+
+
+INSTANCE_ID = 'i-ssm-acquire-test-cache'
+
+
+class StubS3Manager(object):
+    """Serves object metadata and writes downloaded objects to /tmp like S3Manager."""
+
+    def __init__(self, objects=None):
+        self.objects = objects or {}
+        self.downloaded = []
+
+    def get_metadata(self, object_key):
+        if object_key not in self.objects:
+            return None
+        return self.objects[object_key][0]
+
+    def get_files(self, object_keys):
+        for key in object_keys:
+            self.downloaded.append(key['Key'])
+            with open('/tmp/{}'.format(key['Key']), 'wb') as fh:
+                fh.write(self.objects[key['Key']][1])
+
+
+@pytest.fixture
+def instance_dir():
+    directory = '/tmp/{}'.format(INSTANCE_ID)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    yield directory
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def test_cache_key_is_stable():
+    key = cache.cache_key(plugin='psaux', capture='abc', profile='def')
+    assert key == cache.cache_key(profile='def', capture='abc', plugin='psaux')
+    assert key != cache.cache_key(plugin='psaux', capture='abc', profile='xyz')
+    assert len(key) == 64
+
+
+def test_file_digest_is_memoized_by_size_and_mtime(instance_dir, monkeypatch):
+    path = os.path.join(instance_dir, 'capture.aff4')
+    with open(path, 'wb') as fh:
+        fh.write(b'capture')
+    hashed = []
+    digest_file = cache.digest_file
+    monkeypatch.setattr(cache, 'digest_file', lambda p: hashed.append(p) or digest_file(p))
+
+    result_cache = cache.ResultCache(INSTANCE_ID)
+    digest = result_cache.file_digest(path)
+    assert result_cache.file_digest(path) == digest
+    # The manifest is saved, so another run does not hash the file again either.
+    assert cache.ResultCache(INSTANCE_ID).file_digest(path) == digest
+    assert hashed == [path]
+
+    with open(path, 'wb') as fh:
+        fh.write(b'another capture')
+    assert result_cache.file_digest(path) != digest
+    assert hashed == [path, path]
+
+
+def test_is_current_local_hit(instance_dir):
+    with open(os.path.join(instance_dir, 'psaux-output.json'), 'w') as fh:
+        fh.write('[]')
+    s3_manager = StubS3Manager()
+    result_cache = cache.ResultCache(INSTANCE_ID, s3_manager)
+    result_cache.record('psaux-output.json', 'key-1')
+
+    assert cache.ResultCache(INSTANCE_ID, s3_manager).is_current('psaux-output.json', 'key-1') is True
+    assert s3_manager.downloaded == []
+
+
+def test_is_current_downloads_a_result_with_a_matching_key(instance_dir):
+    object_key = '{}/psaux-output.json'.format(INSTANCE_ID)
+    s3_manager = StubS3Manager({object_key: ({cache.CACHE_KEY_METADATA: 'key-1'}, b'[]')})
+    result_cache = cache.ResultCache(INSTANCE_ID, s3_manager)
+
+    assert result_cache.is_current('psaux-output.json', 'key-1') is True
+    assert s3_manager.downloaded == [object_key]
+    assert os.path.isfile(os.path.join(instance_dir, 'psaux-output.json'))
+    assert result_cache.manifest['results'] == {'psaux-output.json': 'key-1'}
+
+
+def test_is_current_miss(instance_dir):
+    object_key = '{}/psaux-output.json'.format(INSTANCE_ID)
+    s3_manager = StubS3Manager({object_key: ({cache.CACHE_KEY_METADATA: 'key-1'}, b'[]')})
+    result_cache = cache.ResultCache(INSTANCE_ID, s3_manager)
+    result_cache.record('netstat-output.json', 'key-2')
+
+    # A different key in the bucket, and a recorded result whose file is gone.
+    assert result_cache.is_current('psaux-output.json', 'key-2') is False
+    assert result_cache.is_current('netstat-output.json', 'key-2') is False
+    assert s3_manager.downloaded == []
@@ -0,0 +1,206 @@
+import json
+import logging
+
+from botocore.exceptions import ClientError
+
+from ssm_acquire import common
+
+
+COMMAND_ID = 'c-1'
+INSTANCE_ID = 'i-1'
+
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'Operation')
+
+
+class StubSsmClient(object):
+    """Returns queued invocations and records cancellations."""
+
+    def __init__(self, invocations, cancel_error=None):
+        self.invocations = list(invocations)
+        self.cancel_error = cancel_error
+        self.cancelled = []
+
+    def get_command_invocation(self, CommandId, InstanceId):
+        if len(self.invocations) > 1:
+            return self.invocations.pop(0)
+        return self.invocations[0]
+
+    def cancel_command(self, CommandId, InstanceIds):
+        self.cancelled.append(CommandId)
+        if self.cancel_error is not None:
+            raise self.cancel_error
+        self.invocations = [{'Status': 'Cancelled'}]
+
+
+class StubLogsClient(object):
+    """Serves log events appended to streams, paging with forward tokens like cloudwatch logs."""
+
+    def __init__(self, error=None):
+        self.streams = {}
+        self.error = error
+        self.calls = []
+
+    def append(self, stream, *messages):
+        name = '{}/{}/aws-runShellScript/{}'.format(COMMAND_ID, INSTANCE_ID, stream)
+        self.streams.setdefault(name, []).extend(messages)
+
+    def get_log_events(self, logGroupName, logStreamName, startFromHead, nextToken=None):
+        self.calls.append((logGroupName, logStreamName, nextToken))
+        if self.error is not None:
+            raise self.error
+        if logStreamName not in self.streams:
+            raise client_error('ResourceNotFoundException')
+        start = int(nextToken.split('/')[1]) if nextToken else 0
+        events = [{'message': message} for message in self.streams[logStreamName][start:start + 2]]
+        return {'events': events, 'nextForwardToken': 'f/{}'.format(start + len(events))}
+
+
+def command(cloudwatch=True):
+    response = {'Command': {'CommandId': COMMAND_ID}}
+    if cloudwatch:
+        response['Command']['CloudWatchOutputConfig'] = {
+            'CloudWatchLogGroupName': common.COMMAND_LOG_GROUP,
+            'CloudWatchOutputEnabled': True
+        }
+    return response
+
+
+def test_output_is_tailed_from_cloudwatch_while_running(caplog):
+    caplog.set_level(logging.INFO)
+    ssm_client = StubSsmClient([{'Status': 'InProgress'}])
+    logs_client = StubLogsClient()
+    monitor = common.CommandMonitor(ssm_client, command(), INSTANCE_ID, logs_client)
+
+    assert monitor.poll() is None
+    logs_client.append('stdout', 'Installing kernel-devel', 'Completed 1.0 MiB/4.0 MiB', 'done')
+    assert monitor.poll() is None
+    assert monitor.progress == {'done': '1.0 MiB', 'total': '4.0 MiB'}
+    assert '[i-1] done' in caplog.messages
+    assert logs_client.calls[-1][:2] == (common.COMMAND_LOG_GROUP, 'c-1/i-1/aws-runShellScript/stderr')
+
+    logs_client.append('stdout', 'linpmem finished')
+    ssm_client.invocations = [{'Status': 'Success', 'StandardOutputContent': 'Installing kernel-devel\n'}]
+    assert monitor.poll() == 'Success'
+    messages = [message for message in caplog.messages if message.startswith('[i-1]')]
+    assert messages == [
+        '[i-1] Installing kernel-devel', '[i-1] Completed 1.0 MiB/4.0 MiB', '[i-1] done', '[i-1] linpmem finished'
+    ]
+
+
+def test_fatal_output_cancels_the_command():
+    ssm_client = StubSsmClient([{'Status': 'InProgress'}])
+    logs_client = StubLogsClient()
+    logs_client.append('stderr', 'cp: error writing: No space left on device')
+    monitor = common.CommandMonitor(ssm_client, command(), INSTANCE_ID, logs_client)
+
+    assert monitor.poll() is None
+    assert ssm_client.cancelled == [COMMAND_ID]
+    assert monitor.cancelled_reason == 'cp: error writing: No space left on device'
+    assert monitor.poll() == 'Cancelled'
+
+
+def test_failure_to_cancel_is_logged_and_polling_continues(caplog):
+    caplog.set_level(logging.INFO)
+    ssm_client = StubSsmClient(
+        [{'Status': 'InProgress'}, {'Status': 'InProgress'}, {'Status': 'Failed'}],
+        cancel_error=client_error('AccessDeniedException')
+    )
+    logs_client = StubLogsClient()
+    logs_client.append('stdout', 'make: *** [all] Error 2')
+    monitor = common.CommandMonitor(ssm_client, command(), INSTANCE_ID, logs_client)
+
+    assert monitor.poll() is None
+    assert ssm_client.cancelled == [COMMAND_ID]
+    assert monitor.cancelled_reason is None
+    assert any('Could not cancel command' in message for message in caplog.messages)
+    assert monitor.poll() is None
+    assert monitor.poll() == 'Failed'
+
+
+def test_inline_output_is_used_without_cloudwatch(caplog):
+    caplog.set_level(logging.INFO)
+    ssm_client = StubSsmClient([
+        {'Status': 'InProgress', 'StandardOutputContent': ''},
+        {'Status': 'Failed', 'StandardOutputContent': 'one\ntwo', 'StandardErrorContent': 'fatal: no repo\n'},
+    ])
+    monitor = common.CommandMonitor(ssm_client, command(cloudwatch=False), INSTANCE_ID, StubLogsClient())
+
+    assert monitor.poll() is None
+    assert monitor.poll() == 'Failed'
+    assert [message for message in caplog.messages if message.startswith('[i-1]')] == [
+        '[i-1] one', '[i-1] two', '[i-1] fatal: no repo'
+    ]
+    assert ssm_client.cancelled == []
+
+
+def test_unreadable_log_streams_fall_back_to_inline_output(caplog):
+    caplog.set_level(logging.INFO)
+    ssm_client = StubSsmClient([
+        {'Status': 'InProgress'},
+        {'Status': 'Success', 'StandardOutputContent': 'done\n'},
+    ])
+    logs_client = StubLogsClient(error=client_error('AccessDeniedException'))
+    monitor = common.CommandMonitor(ssm_client, command(), INSTANCE_ID, logs_client)
+
+    assert monitor.poll() is None
+    assert len(logs_client.calls) == 1
+    assert monitor.poll() == 'Success'
+    assert len(logs_client.calls) == 1
+    assert '[i-1] done' in caplog.messages
+
+
+def test_output_cloudwatch_has_not_caught_up_with_comes_from_the_inline_output(caplog):
+    caplog.set_level(logging.INFO)
+    ssm_client = StubSsmClient([{'Status': 'InProgress'}])
+    logs_client = StubLogsClient()
+    logs_client.append('stdout', 'one')
+    monitor = common.CommandMonitor(ssm_client, command(), INSTANCE_ID, logs_client)
+    assert monitor.poll() is None
+
+    ssm_client.invocations = [{'Status': 'Success', 'StandardOutputContent': 'one\ntwo\nthree\n'}]
+    assert monitor.poll() == 'Success'
+    assert [message for message in caplog.messages if message.startswith('[i-1]')] == [
+        '[i-1] one', '[i-1] two', '[i-1] three'
+    ]
+
+
+def test_throttled_log_reads_back_off_and_resume(caplog):
+    caplog.set_level(logging.INFO)
+    ssm_client = StubSsmClient([{'Status': 'InProgress'}])
+    logs_client = StubLogsClient(error=client_error('ThrottlingException'))
+    logs_client.append('stdout', 'Completed 1.0 MiB/4.0 MiB')
+    monitor = common.CommandMonitor(ssm_client, command(), INSTANCE_ID, logs_client)
+
+    assert monitor.poll() is None
+    assert len(logs_client.calls) == 1
+    logs_client.error = None
+    # The next poll is skipped, the one after reads the streams again.
+    assert monitor.poll() is None
+    assert len(logs_client.calls) == 1
+    assert monitor.poll() is None
+    assert monitor.progress == {'done': '1.0 MiB', 'total': '4.0 MiB'}
+    assert monitor.logs_client is logs_client
+
+
+def test_other_log_read_errors_are_retried():
+    ssm_client = StubSsmClient([{'Status': 'InProgress'}])
+    logs_client = StubLogsClient(error=client_error('InternalFailure'))
+    logs_client.append('stdout', 'done')
+    monitor = common.CommandMonitor(ssm_client, command(), INSTANCE_ID, logs_client)
+
+    assert monitor.poll() is None
+    logs_client.error = None
+    assert monitor.poll() is None
+    assert monitor.tailed['stdout'] == len('done\n')
+
+
+def test_limited_policy_scopes_cancel_and_log_reads(monkeypatch):
+    monkeypatch.setenv('SSM_ACQUIRE_ASSET_BUCKET', 'bucket')
+    policy = json.loads(common.get_limited_policy('us-west-2', INSTANCE_ID))
+    statements = {statement['Sid']: statement for statement in policy['Statement']}
+    assert 'ssm:CancelCommand' in statements['STMT3']['Action']
+    assert statements['STMT3']['Resource'][1] == 'arn:aws:ec2:*:*:instance/i-1'
+    assert statements['STMT5']['Action'] == ['logs:GetLogEvents']
+    assert statements['STMT5']['Resource'] == ['arn:aws:logs:*:*:log-group:/ssm-acquire/commands:*']
@@ -0,0 +1,104 @@
+import json
+
+import boto3
+import pytest
+
+from moto import mock_aws
+
+from ssm_acquire import metrics
+
+
+@pytest.fixture
+def recorder():
+    return metrics.Recorder()
+
+
+def counter(recorder, name, **labels):
+    return recorder.counters.get((name, metrics._label_key(labels)))
+
+
+def test_nested_spans_record_their_parent(recorder):
+    with recorder.span('acquire', instance_id='i-1') as outer:
+        with recorder.span('ssm_poll') as inner:
+            pass
+    assert inner['parent'] == outer['id']
+    assert outer['parent'] is None
+    assert outer['attributes'] == {'instance_id': 'i-1'}
+    assert [span['name'] for span in recorder.to_dict()['spans']] == ['acquire', 'ssm_poll']
+    assert recorder.timers[('span_seconds', (('span', 'acquire'),))][0] == 1
+
+
+def test_failed_spans_have_error_status(recorder):
+    with pytest.raises(ValueError):
+        with recorder.span('analyze') as record:
+            raise ValueError('no capture')
+    assert record['status'] == 'error'
+    assert record['duration'] is not None
+
+    with recorder.span('analyze') as record:
+        pass
+    assert record['status'] == 'ok'
+
+
+def test_counters_and_timers_aggregate_by_labels(recorder):
+    recorder.increment('s3_bytes_downloaded_total', 10)
+    recorder.increment('s3_bytes_downloaded_total', 5)
+    recorder.increment('containers_run_total', plugin='psaux', status=0)
+    recorder.increment('containers_run_total', plugin='psaux', status=0)
+    recorder.increment('containers_run_total', plugin='netstat', status=1)
+    recorder.observe('container_seconds', 2.0, plugin='psaux')
+    recorder.observe('container_seconds', 4.0, plugin='psaux')
+
+    assert counter(recorder, 's3_bytes_downloaded_total') == 15
+    assert counter(recorder, 'containers_run_total', plugin='psaux', status=0) == 2
+    assert counter(recorder, 'containers_run_total', plugin='netstat', status='1') == 1
+    assert recorder.timers[('container_seconds', (('plugin', 'psaux'),))] == (2, 6.0, 4.0)
+
+
+def test_cache_hit_rates(recorder):
+    assert recorder.to_dict()['cache_hit_rates']['result_cache'] is None
+    recorder.increment('result_cache_hits_total', source='local')
+    recorder.increment('result_cache_hits_total', source='s3')
+    recorder.increment('result_cache_misses_total', 2)
+    assert recorder.to_dict()['cache_hit_rates']['result_cache'] == 0.5
+
+
+def test_prometheus_text(recorder):
+    recorder.increment('api_calls_total', service='ssm', operation='SendCommand', status=200)
+    recorder.increment('api_calls_total', service='ssm', operation='GetCommandInvocation', status=200)
+    recorder.observe('container_seconds', 1.5, plugin='say "hi"')
+    assert recorder.prometheus_text().splitlines() == [
+        '# TYPE ssm_acquire_api_calls_total counter',
+        'ssm_acquire_api_calls_total{operation="GetCommandInvocation",service="ssm",status="200"} 1',
+        'ssm_acquire_api_calls_total{operation="SendCommand",service="ssm",status="200"} 1',
+        '# TYPE ssm_acquire_container_seconds summary',
+        'ssm_acquire_container_seconds_count{plugin="say \\"hi\\""} 1',
+        'ssm_acquire_container_seconds_sum{plugin="say \\"hi\\""} 1.5',
+    ]
+
+
+def test_instrument_client_counts_calls_by_operation(recorder, monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        client = recorder.instrument_client(boto3.client('s3'))
+        client.create_bucket(Bucket='bucket')
+        client.list_buckets()
+        client.list_buckets()
+
+    assert counter(recorder, 'api_calls_total', service='s3', operation='CreateBucket', status=200) == 1
+    assert counter(recorder, 'api_calls_total', service='s3', operation='ListBuckets', status=200) == 2
+    assert recorder.timers[('api_call_seconds', (('operation', 'ListBuckets'), ('service', 's3')))][0] == 2
+
+
+def test_write(recorder, tmp_path):
+    with recorder.span('ssm_acquire'):
+        recorder.increment('rows_ingested_total', 3)
+    path = tmp_path / 'trace.json'
+    recorder.write(str(path))
+
+    trace = json.loads(path.read_text())
+    assert [span['name'] for span in trace['spans']] == ['ssm_acquire']
+    assert trace['counters'] == [{'name': 'rows_ingested_total', 'labels': {}, 'value': 3}]
+    assert trace['timers'][0]['name'] == 'span_seconds'
@@ -0,0 +1,110 @@
+import io
+import re
+
+from ssm_acquire import remote
+
+
+class StubS3Client(object):
+    """Serves ranged get_object calls from an in memory object and records each range."""
+
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.data)}
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = (int(value) for value in re.match(r'bytes=(\d+)-(\d+)$', Range).groups())
+        self.ranges.append((start, end))
+        return {'Body': io.BytesIO(self.data[start:end + 1])}
+
+
+def make_reader(size=1000, block_size=100, cache_bytes=1000, prefetch_blocks=0):
+    data = bytes(bytearray(i % 251 for i in range(size)))
+    client = StubS3Client(data)
+    reader = remote.S3RangeReader(
+        client, 'bucket', 'i-1/capture.aff4',
+        block_size=block_size, cache_bytes=cache_bytes, prefetch_blocks=prefetch_blocks
+    )
+    return reader, client, data
+
+
+def test_size_from_head_object():
+    reader, client, data = make_reader(size=1234)
+    assert reader.size == 1234
+    assert client.ranges == []
+
+
+def test_reads_across_block_edges():
+    reader, client, data = make_reader()
+    assert reader.read_at(95, 10) == data[95:105]
+    assert client.ranges == [(0, 99), (100, 199)]
+    assert reader.read_at(99, 1) == data[99:100]
+    assert reader.read_at(100, 1) == data[100:101]
+    assert reader.read_at(0, 200) == data[:200]
+    assert len(client.ranges) == 2
+
+
+def test_reads_stop_at_end_of_object():
+    reader, client, data = make_reader(size=950)
+    assert reader.read_at(940, 100) == data[940:]
+    assert client.ranges[-1] == (900, 949)
+    assert reader.read_at(950, 10) == b''
+    assert reader.read_at(0, 0) == b''
+
+
+def test_file_interface():
+    reader, client, data = make_reader()
+    reader.seek(250)
+    assert reader.read(100) == data[250:350]
+    assert reader.tell() == 350
+    reader.seek(-50, io.SEEK_END)
+    assert reader.read() == data[-50:]
+    buffer = bytearray(30)
+    reader.seek(10)
+    assert reader.readinto(buffer) == 30
+    assert bytes(buffer) == data[10:40]
+
+
+def test_lru_eviction():
+    reader, client, data = make_reader(cache_bytes=300)
+    assert reader.max_cached_blocks == 3
+    for offset in (0, 500, 200):
+        reader.read_at(offset, 1)
+    # Touch block 0 so block 5 is the least recently used.
+    reader.read_at(0, 1)
+    reader.read_at(800, 1)
+    assert list(reader._cache) == [2, 0, 8]
+    assert reader.hits == 1
+    assert reader.misses == 4
+
+    reader.read_at(500, 1)
+    assert client.ranges[-1] == (500, 599)
+    assert reader.misses == 5
+
+
+def test_sequential_reads_prefetch():
+    reader, client, data = make_reader(size=2000, cache_bytes=2000, prefetch_blocks=4)
+    assert reader.read() == data
+    # The first block is fetched alone, then each miss pulls in the next block and four more.
+    assert client.ranges == [(0, 99), (100, 599), (600, 1099), (1100, 1599), (1600, 1999)]
+    assert reader.requests == 5
+    assert reader.bytes_fetched == len(data)
+    assert reader.misses == 5
+    assert reader.hits == 15
+
+
+def test_prefetch_is_bounded_by_the_cache():
+    reader, client, data = make_reader(size=2000, cache_bytes=300, prefetch_blocks=8)
+    reader.read_at(0, 1)
+    reader.read_at(100, 1)
+    assert client.ranges == [(0, 99), (100, 399)]
+    assert len(reader._cache) == 3
+
+
+def test_random_reads_do_not_prefetch():
+    reader, client, data = make_reader(prefetch_blocks=4)
+    for offset in (700, 200, 500):
+        assert reader.read_at(offset, 10) == data[offset:offset + 10]
+    assert client.ranges == [(700, 799), (200, 299), (500, 599)]
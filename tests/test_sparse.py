@@ -0,0 +1,113 @@
+import hashlib
+import io
+import os
+
+import pytest
+
+from ssm_acquire import sparse
+
+
+PAGE_SIZE = sparse.PAGE_SIZE
+
+
+def page(fill):
+    return bytes(bytearray([fill])) * PAGE_SIZE
+
+
+def make_image():
+    """Zero pages, duplicated pages, unique pages and a partial last page."""
+    unique = os.urandom(PAGE_SIZE)
+    return b''.join([
+        page(0), page(1), page(0), page(0), page(1), unique, page(2), page(1), unique, page(0),
+        os.urandom(1000)
+    ])
+
+
+def pack(image, **kwargs):
+    packed = io.BytesIO()
+    stats = sparse.pack(io.BytesIO(image), packed, **kwargs)
+    packed.seek(0)
+    return stats, packed
+
+
+def test_pack_statistics():
+    image = make_image()
+    stats, packed = pack(image)
+    assert stats == {
+        'image_size': len(image),
+        'pages': 11,
+        'zero_pages': 4,
+        'unique_pages': 4,
+        'packed_size': len(packed.getvalue()),
+        'sha256': hashlib.sha256(image).hexdigest(),
+    }
+
+
+@pytest.mark.parametrize('pages_per_chunk', [1, 3, sparse.PAGES_PER_CHUNK])
+def test_round_trip(pages_per_chunk):
+    image = make_image()
+    stats, packed = pack(image, pages_per_chunk=pages_per_chunk)
+    reader = sparse.SparseImageReader(packed, cached_chunks=2)
+
+    assert reader.size == len(image)
+    assert reader.sha256 == hashlib.sha256(image).digest()
+    assert reader.read() == image
+    assert hashlib.sha256(reader.read_at(0, reader.size)).digest() == reader.sha256
+
+
+def test_reads_across_page_boundaries():
+    image = make_image()
+    reader = sparse.SparseImageReader(pack(image, pages_per_chunk=2)[1])
+    for offset, size in [(0, 1), (PAGE_SIZE - 10, 20), (3 * PAGE_SIZE - 1, 2 * PAGE_SIZE + 2),
+                         (len(image) - 10, 100), (len(image), 10), (5, 0)]:
+        assert reader.read_at(offset, size) == image[offset:offset + size]
+
+    reader.seek(-1500, io.SEEK_END)
+    assert reader.read(1000) == image[-1500:-500]
+    assert reader.tell() == len(image) - 500
+
+
+def test_the_last_partial_page_is_not_padded():
+    image = page(7) + b'\x00' * 10
+    stats, packed = pack(image)
+    reader = sparse.SparseImageReader(packed)
+    assert stats['zero_pages'] == 1
+    assert reader.read() == image
+
+
+def test_dedup_table_limit_still_round_trips():
+    image = make_image()
+    stats, packed = pack(image, max_dedup_pages=1)
+    assert stats['unique_pages'] == 5
+    assert sparse.SparseImageReader(packed).read() == image
+
+
+def test_empty_image():
+    stats, packed = pack(b'')
+    reader = sparse.SparseImageReader(packed)
+    assert stats['pages'] == 0
+    assert reader.size == 0
+    assert reader.read() == b''
+
+
+def test_rejects_other_files():
+    with pytest.raises(ValueError):
+        sparse.SparseImageReader(io.BytesIO(b'\x00' * 4096))
+
+    stats, packed = pack(make_image())
+    with pytest.raises(ValueError):
+        sparse.SparseImageReader(io.BytesIO(packed.getvalue()[:-1]))
+
+
+def test_main(tmp_path, capsys):
+    image = make_image()
+    source = tmp_path / 'capture.raw'
+    destination = tmp_path / 'capture.sparse'
+    source.write_bytes(image)
+
+    assert sparse.main(['sparse.py', 'pack', str(source), str(destination)]) == 0
+    assert 'sha256 {}'.format(hashlib.sha256(image).hexdigest()) in capsys.readouterr().out
+    with open(str(destination), 'rb') as fh:
+        assert sparse.SparseImageReader(fh).read() == image
+
+    assert sparse.main(['sparse.py', 'unpack', str(destination)]) == 2
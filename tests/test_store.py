@@ -0,0 +1,199 @@
+import datetime
+import io
+import json
+import os
+import shutil
+
+import pytest
+
+from ssm_acquire import store
+
+
+INTERROGATION_LOG = """---Start system interrogation---
+Listening processes
+[
+  {"name": "sshd", "pid": "812", "port": "22"},
+  {"name": "nc", "pid": "4242", "port": "4444"}
+]
+Logged in users
+[{"user": "ec2-user", "tty": "pts/0"}]
+---End system interrogation---
+"""
+
+
+def write_rekall_output(path, processes):
+    rows = [['m', {'plugin_name': 'psaux'}]]
+    rows.extend(['r', {'proc': {'name': name, 'pid': pid}}] for pid, name in enumerate(processes))
+    rows.append(['p', {}])
+    with open(path, 'w') as fh:
+        json.dump(rows, fh)
+
+
+@pytest.fixture
+def result_store(tmp_path):
+    result_store = store.ResultStore(str(tmp_path / 'results.db'))
+    yield result_store
+    result_store.close()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 65536])
+def test_iter_json_array_across_chunks(chunk_size):
+    document = ' [1, 23456, -7.5e3, "a,]b", {"c": [1, 2]}, [], null, true ]  '
+    assert list(store.iter_json_array(io.StringIO(document), chunk_size)) == json.loads(document)
+
+
+def test_iter_json_array_empty():
+    assert list(store.iter_json_array(io.StringIO('[]'))) == []
+    assert list(store.iter_json_array(io.StringIO(''))) == []
+
+
+@pytest.mark.parametrize('document', ['{"a": 1}', '[1, 2', '[1, {"a": ]'])
+def test_iter_json_array_rejects_invalid_documents(document):
+    with pytest.raises(ValueError):
+        list(store.iter_json_array(io.StringIO(document), 2))
+
+
+def test_iter_rekall_rows():
+    document = json.dumps([['m', {}], ['r', {'a': 1}], ['s', {}], ['r', {'a': 2}]])
+    assert list(store.iter_rekall_rows(io.StringIO(document))) == [{'a': 1}, {'a': 2}]
+
+
+def test_iter_interrogation_rows():
+    rows = list(store.iter_interrogation_rows(io.StringIO(INTERROGATION_LOG)))
+    assert rows == [
+        ('Listening processes', {'name': 'sshd', 'pid': '812', 'port': '22'}),
+        ('Listening processes', {'name': 'nc', 'pid': '4242', 'port': '4444'}),
+        ('Logged in users', {'user': 'ec2-user', 'tty': 'pts/0'}),
+    ]
+
+
+def test_iter_interrogation_rows_skips_truncated_results():
+    log = 'Listening processes\n[\n  {"name": "sshd"},\n'
+    assert list(store.iter_interrogation_rows(io.StringIO(log))) == []
+
+
+def test_flatten():
+    assert sorted(store.flatten({'proc': {'name': 'sshd', 'pid': 1}, 'tags': ['a', 'b'], 'parent': None})) == [
+        ('parent', None), ('proc.name', 'sshd'), ('proc.pid', '1'), ('tags', 'a'), ('tags', 'b')
+    ]
+
+
+def test_ingest_skips_unchanged_and_replaces_changed_sources(tmp_path, result_store):
+    path = str(tmp_path / 'psaux-i-1-output.json')
+    write_rekall_output(path, ['init', 'sshd'])
+
+    assert result_store.ingest_file(path, 'i-1', capture_time=1000) == 2
+    assert result_store.ingest_file(path, 'i-1', capture_time=1000) == 0
+    assert [row for _, _, row in result_store.rows('i-1', 'psaux')] == [
+        {'proc': {'name': 'init', 'pid': 0}}, {'proc': {'name': 'sshd', 'pid': 1}}
+    ]
+
+    write_rekall_output(path, ['init', 'sshd', 'nc'])
+    assert result_store.ingest_file(path, 'i-1', capture_time=2000) == 3
+    assert [capture_time for _, capture_time, _ in result_store.rows('i-1')] == [2000] * 3
+    assert result_store.find_instances({'proc.name': 'nc'}, plugin='psaux') == ['i-1']
+    assert result_store.connection.execute('SELECT COUNT(*) FROM fields').fetchone()[0] == 6
+    assert result_store.connection.execute('SELECT COUNT(*) FROM sources').fetchone()[0] == 1
+
+
+def test_ingest_reindexes_when_only_the_capture_time_changes(tmp_path, result_store):
+    path = str(tmp_path / 'psaux-i-1-output.json')
+    write_rekall_output(path, ['init'])
+    assert result_store.ingest_file(path, 'i-1', capture_time=1000) == 1
+    assert result_store.ingest_file(path, 'i-1', capture_time=2000) == 1
+    assert [capture_time for _, capture_time, _ in result_store.rows('i-1')] == [2000]
+
+
+def test_ingest_directory(tmp_path, result_store):
+    write_rekall_output(str(tmp_path / 'psaux-i-1-output.json'), ['init'])
+    (tmp_path / 'interrogation.log').write_text(INTERROGATION_LOG)
+    (tmp_path / 'capture.aff4').write_bytes(b'\x00' * 16)
+    (tmp_path / 'broken-i-1-output.json').write_text('{"not": "an array"}')
+
+    count = result_store.ingest_directory(str(tmp_path), 'i-1', {'interrogation.log': 1234})
+    assert count == 4
+    plugins = {plugin: capture_time for plugin, capture_time, _ in result_store.rows('i-1')}
+    assert plugins['osquery:listening-processes'] == 1234
+    assert plugins['osquery:logged-in-users'] == 1234
+    assert plugins['psaux'] == os.path.getmtime(str(tmp_path / 'psaux-i-1-output.json'))
+
+
+def test_find_listening(tmp_path, result_store):
+    for instance_id, port in (('i-1', '4444'), ('i-2', '8080')):
+        log_dir = tmp_path / instance_id
+        log_dir.mkdir()
+        (log_dir / 'interrogation.log').write_text(INTERROGATION_LOG.replace('4444', port))
+        result_store.ingest_directory(str(log_dir), instance_id)
+
+    assert result_store.find_listening('nc', 4444) == ['i-1']
+    assert result_store.find_listening('nc', 8080) == ['i-2']
+    assert result_store.find_listening('sshd', 22) == ['i-1', 'i-2']
+    # The name and port have to be on the same row.
+    assert result_store.find_listening('sshd', 4444) == []
+
+
+def test_find_instances_requires_criteria(result_store):
+    with pytest.raises(ValueError):
+        result_store.find_instances({})
+
+
+class StubS3Manager(object):
+    def __init__(self, contents):
+        self.contents = contents
+        self.downloaded = []
+
+    def create_instance_directory(self, instance_id):
+        os.makedirs('/tmp/{}'.format(instance_id), exist_ok=True)
+
+    def list_objects_for_key(self, object_key):
+        return [
+            {'Key': key, 'Size': len(data), 'LastModified': last_modified}
+            for key, (data, last_modified) in sorted(self.contents.items())
+        ]
+
+    def get_files(self, object_keys):
+        for object_key in object_keys:
+            self.downloaded.append(object_key['Key'])
+            with open('/tmp/{}'.format(object_key['Key']), 'wb') as fh:
+                fh.write(self.contents[object_key['Key']][0])
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=datetime.timezone.utc)
+
+
+@pytest.fixture
+def instance_id():
+    instance_id = 'i-ssm-acquire-test-store'
+    shutil.rmtree('/tmp/{}'.format(instance_id), ignore_errors=True)
+    yield instance_id
+    shutil.rmtree('/tmp/{}'.format(instance_id), ignore_errors=True)
+
+
+def test_fetch_results_uses_the_capture_upload_time(instance_id):
+    s3_manager = StubS3Manager({
+        '{}/capture.aff4'.format(instance_id): (b'capture', utc(2018, 11, 25, 20, 0)),
+        '{}/psaux-{}-output.json'.format(instance_id, instance_id): (b'[]', utc(2018, 11, 25, 21, 0)),
+        '{}/interrogation.log'.format(instance_id): (b'', utc(2018, 11, 25, 22, 0)),
+    })
+    directory, capture_times = store.fetch_results(s3_manager, instance_id)
+
+    assert directory == '/tmp/{}'.format(instance_id)
+    assert capture_times == {
+        'psaux-{}-output.json'.format(instance_id): 1543176000,
+        'interrogation.log': 1543176000,
+    }
+    assert sorted(s3_manager.downloaded) == [
+        '{}/interrogation.log'.format(instance_id), '{}/psaux-{}-output.json'.format(instance_id, instance_id)
+    ]
+
+    s3_manager.downloaded = []
+    assert store.fetch_results(s3_manager, instance_id)[1] == capture_times
+    assert s3_manager.downloaded == []
+
+
+def test_fetch_results_without_a_capture_uses_the_result_upload_time(instance_id):
+    s3_manager = StubS3Manager({
+        '{}/interrogation.log'.format(instance_id): (b'', utc(2018, 11, 25, 22, 0)),
+    })
+    assert store.fetch_results(s3_manager, instance_id)[1] == {'interrogation.log': 1543183200}